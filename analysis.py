@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Provide spot analysis of the rays landing on an OutputPlane(), in one vectorised pass or chunk by chunk.
+"""
+
+import numpy as np
+import utils as ut
+import rays
+import opticalelements
+import simulation
+import materials
+import paraxial
+
+def spot(source):
+    """
+    Return the (N, 2) transverse positions of the rays of a Simulation(), a RayBundle() or an (N, 2) / (N, 3) array.
+    Terminated rays are left out. The positions are returned in float64 whatever the precision of the rays.
+    """
+    if hasattr(source, "bundles"): #Simulation()
+        loose = np.array([ray.p()[:2] for ray in source.loose() if not ray.terminated]).reshape(-1, 2)
+        return np.concatenate([loose] + [spot(bundle) for bundle in source.bundles()])
+    if hasattr(source, "p"): #RayBundle()
+        return np.asarray(source.p()[source.alive(), :2], dtype=float)
+    points = np.asarray(source, dtype=float)
+    if points.size == 0:
+        return np.zeros((0, 2))
+    return points.reshape(len(points), -1)[:, :2]
+
+def centroid(source):
+    return spot(source).mean(axis=0)
+
+def radii(source, centre=None):
+    """
+    Distances of the spots from the centre, the centroid by default.
+    """
+    points = spot(source)
+    if centre is None:
+        centre = points.mean(axis=0)
+    diff = points - np.asarray(centre, dtype=float)[:2]
+    return np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1])
+
+def rms(source, centre=None):
+    """
+    Calculate the RMS spot radius about the centre, the centroid by default.
+    """
+    r = radii(source, centre)
+    return np.sqrt(np.mean(r * r))
+
+def maxradius(source, centre=None):
+    """
+    Geometric spot radius, the largest distance from the centre.
+    """
+    return radii(source, centre).max()
+
+def encircled(source, fraction, centre=None):
+    """
+    Radius of the circle about the centre enclosing the given fraction(s) of the rays.
+    """
+    return np.quantile(radii(source, centre), fraction)
+
+def empty(fractions):
+    """
+    Spot statistics without any rays
+    """
+    return {"count": 0, "centroid": np.full(2, np.nan), "rms": np.nan, "maxradius": np.nan,
+            "encircled": dict(zip(fractions, [np.nan] * len(fractions)))}
+
+def statistics(source, fractions=(0.5, 0.8, 0.9), centre=None):
+    """
+    Return all spot statistics from one pass over the positions, NaN but the count when no ray is left.
+    """
+    points = spot(source)
+    if len(points) == 0:
+        return empty(fractions)
+    if centre is None:
+        centre = points.mean(axis=0)
+    r = radii(points, centre)
+    return {"count": len(points), "centroid": points.mean(axis=0), "rms": float(np.sqrt(np.mean(r * r))), "maxradius": float(r.max()),
+            "encircled": dict(zip(fractions, np.quantile(r, fractions).tolist()))}
+
+class SpotStatistics:
+    """
+    Accumulate spot statistics chunk by chunk so the positions never need to be held in memory together.
+    The centroid and the RMS radius are exact, using the parallel form of Welford's algorithm.
+    The geometric radius and the encircled radii are measured from a reference point fixed up front, the optical axis by default,
+    the encircled radii come from a logarithmic histogram with the given number of bins per decade.
+    """
+
+    def __init__(self, centre=np.zeros(2), binsperdecade=1000, rmin=1e-9, rmax=1e6):
+        self.__centre = np.asarray(centre, dtype=float)[:2]
+        self.__count = 0
+        self.__mean = np.zeros(2)
+        self.__m2 = float(0)
+        self.__maxradius = float(0)
+        self.__edges = np.logspace(np.log10(rmin), np.log10(rmax), int(binsperdecade * np.log10(rmax / rmin)) + 1)
+        self.__histogram = np.zeros(len(self.__edges) + 1, dtype=np.int64)
+
+    def update(self, source):
+        """
+        Add a chunk of positions.
+        """
+        points = spot(source)
+        n = len(points)
+        if n == 0:
+            return
+        mean = points.mean(axis=0)
+        diff = points - mean
+        m2 = float(np.sum(diff * diff))
+        delta = mean - self.__mean
+        total = self.__count + n
+        self.__m2 = self.__m2 + m2 + delta.dot(delta) * self.__count * n / total
+        self.__mean = self.__mean + delta * n / total
+        self.__count = total
+        r = radii(points, self.__centre)
+        self.__maxradius = max(self.__maxradius, r.max())
+        self.__histogram += np.bincount(np.searchsorted(self.__edges, r), minlength=len(self.__histogram))
+
+    def count(self):
+        return self.__count
+
+    def centroid(self):
+        return self.__mean
+
+    def rms(self, centre=None):
+        """
+        RMS spot radius about the centre, the centroid by default.
+        """
+        if self.__count == 0:
+            return np.nan
+        offset = float(0) if centre is None else np.sum((self.__mean - np.asarray(centre, dtype=float)[:2]) ** 2)
+        return np.sqrt(self.__m2 / self.__count + offset)
+
+    def maxradius(self):
+        return self.__maxradius
+
+    def encircled(self, fraction):
+        """
+        Upper bound of the radius about the reference point enclosing the given fraction of the rays.
+        """
+        cumulative = np.cumsum(self.__histogram)
+        index = np.searchsorted(cumulative, np.asarray(fraction) * self.__count)
+        edges = np.append(self.__edges, np.inf)
+        return np.minimum(edges[np.minimum(index, len(edges) - 1)], self.__maxradius)
+
+    def statistics(self, fractions=(0.5, 0.8, 0.9)):
+        if self.__count == 0:
+            return empty(fractions)
+        return {"count": self.__count, "centroid": self.__mean, "rms": float(self.rms()), "maxradius": float(self.__maxradius),
+                "encircled": dict(zip(fractions, self.encircled(fractions).tolist()))}
+
+    def __repr__(self):
+        return "%s(count=%d, centroid=%s, rms=%g)" % ("SpotStatistics", self.__count, self.__mean, self.rms())
+
+def focus_moments(p, k, alive=None):
+    """
+    Moments of the straight lines x = A + B z followed by rays leaving the last surface, summed over x and y.
+    Return the count and the sums of A, B, A * A, A * B and B * B, these add up over chunks.
+    The rays may be stacked as (..., N, 3) arrays, e.g. one row per design, giving (..., 8) moments,
+    and only the rays in the mask alive are counted when it is given.
+    """
+    p, k = np.asarray(p, dtype=float), np.asarray(k, dtype=float) #the sums cancel in the variances
+    with np.errstate(invalid='ignore', divide='ignore'):
+        B = k[..., :2] / k[..., 2:3]
+    A = p[..., :2] - p[..., 2:3] * B
+    if alive is None:
+        n = np.full(p.shape[:-2], p.shape[-2], dtype=float)
+    else:
+        A = np.where(alive[..., np.newaxis], A, 0)
+        B = np.where(alive[..., np.newaxis], B, 0)
+        n = np.sum(alive, axis=-1, dtype=float)
+    return np.concatenate([n[..., np.newaxis], A.sum(axis=-2), B.sum(axis=-2), np.sum(A * A, axis=(-2, -1))[..., np.newaxis],
+                           np.sum(A * B, axis=(-2, -1))[..., np.newaxis], np.sum(B * B, axis=(-2, -1))[..., np.newaxis]], axis=-1)
+
+def focus_spread(moments):
+    """
+    Variance of A, covariance of A and B and variance of B about the centroid from the moments of focus_moments(),
+    the squared RMS radius on the plane z is varA + 2 covAB z + varB z^2.
+    """
+    moments = np.asarray(moments, dtype=float)
+    n, a, b = moments[..., 0], moments[..., 1:3], moments[..., 3:5]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        varA = moments[..., 5] / n - np.sum(a * a, axis=-1) / n ** 2
+        covAB = moments[..., 6] / n - np.sum(a * b, axis=-1) / n ** 2
+        varB = moments[..., 7] / n - np.sum(b * b, axis=-1) / n ** 2
+    return varA, covAB, varB
+
+def focus_curve(moments, z):
+    """
+    RMS spot radius about the centroid on the planes z, from the moments of focus_moments().
+    """
+    varA, covAB, varB = focus_spread(moments)
+    z = np.asarray(z, dtype=float)
+    return np.sqrt(np.maximum(varA + 2 * covAB * z + varB * z * z, 0))
+
+def best_focus(moments):
+    """
+    Plane of minimum RMS spot radius and the RMS radius there, the minimum of the quadratic of focus_spread().
+    The moments may be stacked as for focus_moments(). Both are NaN without rays or when the rays are all parallel.
+    """
+    varA, covAB, varB = focus_spread(moments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.where(varB > 0, - covAB / varB, np.nan)
+    rms = np.sqrt(np.maximum(varA + 2 * covAB * z + varB * z * z, 0))
+    return z[()], rms[()]
+
+def find_best_focus(sim, bundle, z=None, paraxialheight=0.1, chunk_size=65536):
+    """
+    Find the plane of minimum RMS spot radius behind the last refracting surface of the system.
+    The rays are traced once up to the last surface, trailing OutputPlane() elements are ignored.
+    After the last surface every ray is a straight line, so the RMS radius is a quadratic in z known for all planes at once.
+    The bundle itself is not modified and terminated rays are left out. The paraxial focus comes from the ABCD matrix of the system,
+    see paraxial.py, or when the beam or the system is off axis from tracing a single ray at paraxialheight.
+    Return a dictionary with the best focus, its RMS radius, the RMS radius on the planes z and the paraxial focus.
+    """
+    surfaces = list(sim.elements())
+    while surfaces and isinstance(surfaces[-1], opticalelements.OutputPlane):
+        surfaces.pop()
+    front = simulation.Simulation()
+    front.appendelements(*surfaces)
+    moments = np.zeros(8)
+    for chunk in front.propagate_iter(rays.RayBundle(bundle.p(), bundle.k(), bundle.freq(), wavelength=bundle.wavelength(), dtype=bundle.dtype()), chunk_size):
+        alive = chunk.alive()
+        moments += focus_moments(chunk.p()[alive], chunk.k()[alive])
+    bestfocus, bestrms = best_focus(moments)
+    
+    kmean = bundle.k().mean(axis=0)
+    paraxialfocus = paraxial.focus(surfaces) if abs(kmean[0]) + abs(kmean[1]) <= 1e-12 * abs(kmean[2]) else np.nan
+    if not np.isfinite(paraxialfocus): #off-axis beam or system, trace a ray instead
+        origin = bundle.p().mean(axis=0) + ut.vec([0, paraxialheight, 0])
+        ray = rays.RayBundle([origin], kmean)
+        front.trace(ray)
+        p, k = ray.p()[0], ray.k()[0]
+        paraxialfocus = p[2] - (p[1] - origin[1] + paraxialheight) * k[2] / k[1] if k[1] != 0 else np.nan
+    
+    if z is None:
+        last = max([elem.pos()[2] for elem in surfaces], default=0)
+        guess = paraxialfocus if np.isfinite(paraxialfocus) else bestfocus
+        z = np.linspace(last, guess + (guess - last), 1001)
+    return {"bestfocus": bestfocus, "rms": float(bestrms), "z": np.asarray(z, dtype=float),
+            "rmscurve": focus_curve(moments, z), "paraxialfocus": paraxialfocus}
+
+def chromatic(sim, bundle, reference=materials.D_LINE, chunk_size=65536):
+    """
+    Chromatic focus report of a polychromatic bundle, see rays.polychromatic().
+    The rays are traced once up to the last surface and the focus moments are summed for every wavelength separately.
+    Return a dictionary with the wavelengths, their best focus, the RMS radius there, the focal shift from the reference wavelength
+    (or from the wavelength closest to it) and the RMS radius on the final OutputPlane(), NaN when the system has none.
+    """
+    surfaces = list(sim.elements())
+    output = surfaces[-1].pos()[2] if surfaces and isinstance(surfaces[-1], opticalelements.OutputPlane) else np.nan
+    while surfaces and isinstance(surfaces[-1], opticalelements.OutputPlane):
+        surfaces.pop()
+    front = simulation.Simulation()
+    front.appendelements(*surfaces)
+    waves = np.unique(bundle.wavelength())
+    moments = np.zeros((len(waves), 8))
+    for chunk in front.propagate_iter(rays.RayBundle(bundle.p(), bundle.k(), bundle.freq(), wavelength=bundle.wavelength(), dtype=bundle.dtype()), chunk_size):
+        alive = chunk.alive()
+        p, k, group = chunk.p()[alive], chunk.k()[alive], np.searchsorted(waves, chunk.wavelength()[alive])
+        for i in np.unique(group):
+            moments[i] += focus_moments(p[group == i], k[group == i])
+    bestfocus, bestrms = best_focus(moments)
+    outputrms = np.where(moments[:, 0] > 0, focus_curve(moments, output), np.nan)
+    shift = bestfocus - bestfocus[np.argmin(np.abs(waves - reference))]
+    return {"wavelength": waves, "bestfocus": bestfocus, "rms": bestrms, "focalshift": shift, "outputrms": outputrms}
+
+def precision_check(sim, source, sample=10000, tolerance=1e-3, seed=0, chunk_size=65536):
+    """
+    Trace a random sample of the rays of a source in float64 and in float32 through the system of a Simulation()
+    and compare the RMS spot radius about the centroid on the final element, wavelength by wavelength.
+    The sample is traced by a separate Simulation() with the same elements, so hooks and checkpoints are not touched.
+    Return a dictionary with the wavelengths, the RMS radii in both precisions, the largest absolute and relative deviation
+    of the RMS radius, the largest deviation of a final position, the number of rays whose status differs
+    and whether float32 is safe, i.e. the relative deviation is within tolerance.
+    """
+    bundle = rays.collect(source, chunk_size)
+    pick = np.arange(len(bundle))
+    if len(bundle) > sample:
+        pick = np.sort(np.random.default_rng(seed).choice(len(bundle), int(sample), replace=False))
+    p, k, freq, wavelength = bundle.p()[pick], bundle.k()[pick], bundle.freq()[pick], bundle.wavelength()[pick]
+    traced = {}
+    for dtype in ("float64", "float32"):
+        check = simulation.Simulation(sequential=sim.sequential(), maxbounces=sim.maxbounces())
+        check.appendelements(*sim.elements())
+        traced[dtype] = rays.RayBundle(p, k, freq, wavelength=wavelength, dtype=dtype)
+        check.trace(traced[dtype])
+    double, single = traced["float64"], traced["float32"]
+    waves = np.unique(wavelength)
+    rms64, rms32 = np.full(len(waves), np.nan), np.full(len(waves), np.nan)
+    for i, wave in enumerate(waves):
+        select = wavelength == wave
+        if np.any(select & double.alive()):
+            rms64[i] = rms(double.p()[select & double.alive()])
+        if np.any(select & single.alive()):
+            rms32[i] = rms(single.p()[select & single.alive()])
+    deviation = np.abs(rms32 - rms64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = deviation / rms64
+    both = double.alive() & single.alive()
+    position = ut.norms(double.p()[both] - single.p()[both].astype(float)).max(initial=0)
+    worst = float(np.nanmax(relative)) if np.any(np.isfinite(relative)) else np.nan
+    return {"rays": len(pick), "wavelength": waves, "rms64": rms64, "rms32": rms32, "deviation": float(np.nanmax(deviation, initial=0)),
+            "relative": worst, "position": float(position), "status": int(np.count_nonzero(double.status() != single.status())),
+            "safe": bool(worst <= tolerance)}
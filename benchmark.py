@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of the tracer on the systems of testing.py and on synthetic stacks of lenses.
+Results are written as JSON and can be compared with a stored baseline, e.g.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import rays
+import simulation
+import opticalelements
+import paraxial
+
+SIZES = tuple(10 ** e for e in range(2, 8))
+
+def singlet():
+    """
+    Task 9 / 12, a single spherical surface with the output plane at its paraxial focus, see paraxial.py
+    """
+    surfaces = [opticalelements.SphericalRefraction(0.03, 1/0.03, [0,0,100])]
+    return surfaces + [opticalelements.OutputPlane([0,0,paraxial.focus(surfaces)])]
+
+def planoconvex():
+    """
+    The plano-convex lens of Task 15 with the curved side facing the beam, but leaving the flat side into air rather than glass,
+    with the output plane at its paraxial focus
+    """
+    surfaces = [opticalelements.SphericalRefraction(0.02, 1/0.02, [0,0,100], 1, 1.5168),
+                opticalelements.Plane([0,0,105], 1.5168, 1, width=np.array([5,0,0]), height=np.array([0,5,0]))]
+    return surfaces + [opticalelements.OutputPlane([0,0,paraxial.focus(surfaces)])]
+
+def stack(lenses):
+    """
+    A synthetic stack of weak biconvex lenses, two surfaces each, ending with an output plane
+    """
+    elements = []
+    for i in range(lenses):
+        z = 100 + 20 * i
+        elements.append(opticalelements.SphericalRefraction(0.002, 10, [0,0,z], 1, 1.5168))
+        elements.append(opticalelements.SphericalRefraction(-0.002, 10, [0,0,z + 5], 1.5168, 1))
+    elements.append(opticalelements.OutputPlane([0,0,100 + 20 * lenses + 50]))
+    return elements
+
+SCENARIOS = {"singlet": (singlet, 5), "planoconvex": (planoconvex, 4),
+             "stack4": (lambda: stack(4), 5), "stack16": (lambda: stack(16), 5)}
+
+def beam(N, radius, seed=0):
+    """
+    N collimated rays spread uniformly over a disc of the given radius, the same for every run
+    """
+    rng = np.random.default_rng(seed)
+    r = radius * np.sqrt(rng.random(N))
+    phi = 2 * np.pi * rng.random(N)
+    return rays.RayBundle(np.column_stack([r * np.cos(phi), r * np.sin(phi), np.zeros(N)]), [0,0,1])
+
+def elementtimes(sim, bundle):
+    """
+    Time spent in the batch kernel of every element, the rays terminated by an element are not passed on.
+    """
+    p, k = bundle.p(), bundle.k()
+    seconds = []
+    for kernel, constants, media in sim.compile(bundle.dtype()).stages():
+        start = time.perf_counter()
+        newp, newk, status = kernel(constants, p, k)
+        seconds.append(time.perf_counter() - start)
+        alive = status == rays.ALIVE
+        p, k = newp[alive], newk[alive]
+    return seconds
+
+def measure(name, N, repeat=3, budget=1.0):
+    """
+    Benchmark one scenario with N rays.
+    The trace is repeated up to repeat times, or until budget seconds have passed, and the fastest run is kept.
+    The peak memory of the trace is measured in a separate run as tracing allocations slows it down.
+    """
+    build, radius = SCENARIOS[name]
+    sim = simulation.Simulation()
+    sim.appendelements(*build())
+    sim.compile()
+    best, spent = np.inf, 0
+    for i in range(max(int(repeat), 1)):
+        bundle = beam(N, radius)
+        start = time.perf_counter()
+        sim.trace(bundle)
+        elapsed = time.perf_counter() - start
+        best, spent = min(best, elapsed), spent + elapsed
+        if spent > budget:
+            break
+    alive = int(bundle.alive().sum())
+    bundle = beam(N, radius)
+    tracemalloc.start()
+    sim.trace(bundle)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"scenario": name, "rays": N, "elements": len(sim.elements()), "alive": alive, "seconds": best,
+            "rays_per_second": N / best, "peak_memory": peak, "element_seconds": elementtimes(sim, beam(N, radius))}
+
+def run(scenarios=None, sizes=SIZES, repeat=3, budget=1.0, log=None):
+    """
+    Benchmark every scenario at every bundle size, return the results with a description of the machine.
+    """
+    results = []
+    for name in scenarios or list(SCENARIOS):
+        for N in sizes:
+            result = measure(name, int(N), repeat, budget)
+            if log is not None:
+                log("%-12s %9d rays %12.0f rays/s %10.1f MB" % (name, N, result["rays_per_second"], result["peak_memory"] / 2 ** 20))
+            results.append(result)
+    return {"machine": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                        "processor": platform.processor()},
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Regressions of a report against a baseline report, matched by scenario and number of rays.
+    A throughput below (1 - tolerance) of the baseline, or a peak memory above (1 + tolerance) of it, is a regression.
+    """
+    reference = {(result["scenario"], result["rays"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        base = reference.get((result["scenario"], result["rays"]))
+        if base is None:
+            continue
+        if result["rays_per_second"] < (1 - tolerance) * base["rays_per_second"]:
+            regressions.append("%s with %d rays: %.0f rays/s against %.0f in the baseline"
+                               % (result["scenario"], result["rays"], result["rays_per_second"], base["rays_per_second"]))
+        if result["peak_memory"] > (1 + tolerance) * base["peak_memory"]:
+            regressions.append("%s with %d rays: peak memory %d bytes against %d in the baseline"
+                               % (result["scenario"], result["rays"], result["peak_memory"], base["peak_memory"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ray tracer.")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="scenarios to run, all by default")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES), help="bundle sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the fastest is kept")
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds after which no further runs are made")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args(argv)
+    report = run(args.scenarios, args.sizes, args.repeat, args.budget, log=print)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Provide a bounding-volume hierarchy culling the optical elements a batch of rays could hit.
+"""
+
+import numpy as np
+
+def area(lower, upper):
+    """
+    Surface areas of boxes
+    """
+    d = upper - lower
+    return 2 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+def split(lower, upper):
+    """
+    Order of the boxes and the position of the split with the lowest surface area heuristic cost over the three axes.
+    """
+    n = len(lower)
+    centres = (lower + upper) / 2
+    best = (np.inf, None, n // 2)
+    for axis in range(3):
+        order = np.argsort(centres[:, axis], kind="stable")
+        lo, hi = lower[order], upper[order]
+        left = area(np.minimum.accumulate(lo), np.maximum.accumulate(hi))
+        right = area(np.minimum.accumulate(lo[::-1]), np.maximum.accumulate(hi[::-1]))[::-1]
+        cost = left[:-1] * np.arange(1, n) + right[1:] * np.arange(n - 1, 0, -1)
+        i = np.argmin(cost)
+        if cost[i] < best[0]:
+            best = (cost[i], order, i + 1)
+    return best[1], best[2]
+
+class BVH:
+    """
+    A bounding-volume hierarchy over the axis-aligned boxes (lower, upper) of M items.
+    Items are sorted by their box centres and split where the summed surface areas of the two halves, weighted by their sizes,
+    are smallest, until at most leafsize remain in a node.
+    Unbounded items are kept apart and are candidates for every ray.
+    The nodes are stored in flat arrays, children and leaf item ranges are given by index.
+    """
+
+    def __init__(self, lower, upper, leafsize=2):
+        lower = np.asarray(lower, dtype=float).reshape(-1, 3)
+        upper = np.asarray(upper, dtype=float).reshape(-1, 3)
+        bounded = np.all(np.isfinite(lower) & np.isfinite(upper), axis=1)
+        pad = 1e-9 * (1 + np.maximum(np.abs(lower), np.abs(upper))) #flat boxes such as planes get a thickness
+        lower, upper = lower - pad, upper + pad
+        self.__size = len(lower)
+        self.__unbounded = np.flatnonzero(~bounded)
+        items, lo, hi, left, right, first, count = [], [], [], [], [], [], []
+        stack = [(np.flatnonzero(bounded), -1, 0)] if bounded.any() else []
+        while stack:
+            members, parent, side = stack.pop()
+            node = len(lo)
+            if parent >= 0:
+                (left if side == 0 else right)[parent] = node
+            lo.append(lower[members].min(axis=0))
+            hi.append(upper[members].max(axis=0))
+            left.append(-1)
+            right.append(-1)
+            if len(members) <= leafsize:
+                first.append(len(items))
+                count.append(len(members))
+                items.extend(members)
+                continue
+            first.append(0)
+            count.append(0)
+            order, half = split(lower[members], upper[members])
+            stack.append((members[order[half:]], node, 1))
+            stack.append((members[order[:half]], node, 0))
+        self.__items = np.array(items, dtype=int)
+        self.__lower = np.array(lo).reshape(-1, 3)
+        self.__upper = np.array(hi).reshape(-1, 3)
+        self.__left = np.array(left, dtype=int)
+        self.__right = np.array(right, dtype=int)
+        self.__first = np.array(first, dtype=int)
+        self.__count = np.array(count, dtype=int)
+
+    def __len__(self):
+        return self.__size
+
+    def nodes(self):
+        return len(self.__lower)
+
+    def unbounded(self):
+        return self.__unbounded
+
+    def slab(self, node, p, inverse):
+        """
+        Entry distances of the rays into the boxes of the nodes, infinite for rays passing by.
+        """
+        with np.errstate(invalid='ignore'):
+            t1 = (self.__lower[node] - p) * inverse
+            t2 = (self.__upper[node] - p) * inverse
+        tmin = np.maximum(np.fmin(t1, t2).max(axis=1), 0)
+        return np.where(np.fmax(t1, t2).min(axis=1) >= tmin, tmin, np.inf)
+
+    def nearest(self, p, khat, distance):
+        """
+        Nearest hit of the (N, 3) rays p + t khat, t > 0, among the items.
+        distance(ray, item) gives the distances along the rays to the items for arrays of pairs, NaN for a miss.
+        Every step each ray opens the closest node it has left, nodes further than the best hit so far are culled,
+        so a ray only visits the nodes around its path down to the nearest leaves.
+        Return the best distance (infinite for rays hitting nothing) and item (-1) of every ray.
+        """
+        N = len(p)
+        best, bestitem = np.full(N, np.inf), np.full(N, -1)
+        with np.errstate(divide='ignore'):
+            inverse = 1 / khat
+
+        def update(ray, item):
+            t = distance(ray, item)
+            better = t < best[ray] #NaN is never better
+            ray, item, t = ray[better], item[better], t[better]
+            order = np.lexsort((t, ray))
+            ray, item, t = ray[order], item[order], t[order]
+            first = np.r_[True, ray[1:] != ray[:-1]] if len(ray) else np.zeros(0, dtype=bool)
+            best[ray[first]], bestitem[ray[first]] = t[first], item[first]
+
+        if len(self.__unbounded):
+            update(np.repeat(np.arange(N), len(self.__unbounded)), np.tile(self.__unbounded, N))
+        if len(self.__lower) == 0:
+            return best, bestitem
+        ray = np.arange(N)
+        node = np.zeros(N, dtype=int)
+        tmin = self.slab(node, p, inverse)
+        while len(ray):
+            keep = tmin < best[ray]
+            ray, node, tmin = ray[keep], node[keep], tmin[keep]
+            if len(ray) == 0:
+                break
+            order = np.lexsort((tmin, ray))
+            ray, node, tmin = ray[order], node[order], tmin[order]
+            first = np.r_[True, ray[1:] != ray[:-1]]
+            openray, opennode = ray[first], node[first]
+            ray, node, tmin = ray[~first], node[~first], tmin[~first]
+            leaf = self.__left[opennode] < 0
+            leafray, leafnode = openray[leaf], opennode[leaf]
+            count = self.__count[leafnode]
+            offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            update(np.repeat(leafray, count), self.__items[np.repeat(self.__first[leafnode], count) + offset])
+            innerray, innernode = openray[~leaf], opennode[~leaf]
+            childray = np.concatenate([innerray, innerray])
+            childnode = np.concatenate([self.__left[innernode], self.__right[innernode]])
+            ray = np.concatenate([ray, childray])
+            node = np.concatenate([node, childnode])
+            tmin = np.concatenate([tmin, self.slab(childnode, p[childray], inverse[childray])])
+        return best, bestitem
+
+    def __repr__(self):
+        return "%s(items=%d, nodes=%d, unbounded=%d)" % ("BVH", self.__size, len(self.__lower), len(self.__unbounded))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache the final state of traced rays, keyed by a hash of the system and the source.
+The cache has an in-memory tier and an optional on-disk tier, each bounded in bytes and evicting the least recently used results.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import rays
+import tracefile
+
+VERSION = 1
+ARRAYS = ("p", "k", "freq", "wavelength", "status", "count")
+
+def describe(source):
+    """
+    Description of a source of rays: the parameters of a beam, or a digest of the arrays of a RayBundle()
+    """
+    if isinstance(source, rays.RayBundle):
+        digest = hashlib.sha256()
+        for array in (source.p(), source.k(), source.freq(), source.wavelength(), source.status()):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return {"type": "RayBundle", "rays": len(source), "sha256": digest.hexdigest()}
+    if isinstance(source, rays.PolychromaticSource):
+        return {"type": "PolychromaticSource", "source": describe(source.source()), "wavelengths": source.wavelengths().tolist()}
+    return {"type": type(source).__name__, "params": {name: tracefile.jsonable(value) for name, value in source.params().items()}}
+
+def key(sim, source):
+    """
+    Stable hash of the elements, the tracing mode and the source.
+    The elements are described by the full-precision parameters which rebuild them rather than their repr,
+    which rounds to six digits.
+    """
+    description = {"version": VERSION, "elements": tracefile.describe(sim.elements()), "sequential": sim.sequential(),
+                   "maxbounces": sim.maxbounces(), "source": describe(source)}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+def nbytes(arrays):
+    return sum(array.nbytes for array in arrays.values())
+
+class MemoryCache:
+    """
+    Results held in memory, at most maxbytes in total.
+    """
+
+    def __init__(self, maxbytes=2 ** 30):
+        self.__maxbytes = int(maxbytes)
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__evictions = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def size(self):
+        return self.__size
+
+    def evictions(self):
+        return self.__evictions
+
+    def get(self, key):
+        arrays = self.__entries.get(key)
+        if arrays is not None:
+            self.__entries.move_to_end(key)
+        return arrays
+
+    def put(self, key, arrays):
+        if nbytes(arrays) > self.__maxbytes:
+            return
+        if key in self.__entries:
+            self.__size -= nbytes(self.__entries.pop(key))
+        self.__entries[key] = arrays
+        self.__size += nbytes(arrays)
+        while self.__size > self.__maxbytes:
+            self.__size -= nbytes(self.__entries.popitem(last=False)[1])
+            self.__evictions += 1
+
+    def clear(self):
+        self.__entries.clear()
+        self.__size = 0
+
+    def __repr__(self):
+        return "%s(entries=%d, size=%d, maxbytes=%d)" % ("MemoryCache", len(self), self.__size, self.__maxbytes)
+
+class DiskCache:
+    """
+    Results stored as .npz files in a directory, at most maxbytes in total.
+    The modification time of a file is refreshed on every hit and orders the eviction, so the directory can be shared between runs.
+    """
+
+    def __init__(self, directory, maxbytes=2 ** 33):
+        self.__directory = directory
+        self.__maxbytes = int(maxbytes)
+        self.__evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __filename(self, key):
+        return os.path.join(self.__directory, key + ".npz")
+
+    def __entries(self):
+        """
+        (modification time, size, path) of every stored result
+        """
+        entries = []
+        for name in os.listdir(self.__directory):
+            if name.endswith(".npz"):
+                path = os.path.join(self.__directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: #evicted by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def __len__(self):
+        return len(self.__entries())
+
+    def __contains__(self, key):
+        return os.path.exists(self.__filename(key))
+
+    def directory(self):
+        return self.__directory
+
+    def size(self):
+        return sum(size for mtime, size, path in self.__entries())
+
+    def evictions(self):
+        return self.__evictions
+
+    def get(self, key):
+        try:
+            with np.load(self.__filename(key)) as data:
+                arrays = {name: data[name] for name in ARRAYS}
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+        os.utime(self.__filename(key))
+        return arrays
+
+    def put(self, key, arrays):
+        if nbytes(arrays) > self.__maxbytes:
+            return
+        temporary = self.__filename(key) + ".tmp"
+        with open(temporary, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, self.__filename(key))
+        entries = self.__entries()
+        size = sum(size for mtime, size, path in entries)
+        for mtime, filesize, path in entries:
+            if size <= self.__maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= filesize
+            self.__evictions += 1
+
+    def clear(self):
+        for mtime, size, path in self.__entries():
+            os.remove(path)
+
+    def __repr__(self):
+        return "%s(directory=%r, maxbytes=%d)" % ("DiskCache", self.__directory, self.__maxbytes)
+
+class TraceCache:
+    """
+    A two-tier cache of traced rays. Results found on disk are promoted to memory, new results are stored in both tiers.
+    Only the final state of the rays is kept: positions, directions, frequencies, wavelengths, status and number of vertices.
+    """
+
+    def __init__(self, memory=None, disk=None):
+        self.__memory = MemoryCache() if memory is None else memory
+        self.__disk = disk
+        self.__hits = {"memory": 0, "disk": 0}
+        self.__misses = 0
+
+    def memory(self):
+        return self.__memory
+
+    def disk(self):
+        return self.__disk
+
+    def get(self, key):
+        arrays = self.__memory.get(key)
+        if arrays is not None:
+            self.__hits["memory"] += 1
+            return arrays
+        if self.__disk is not None:
+            arrays = self.__disk.get(key)
+            if arrays is not None:
+                self.__hits["disk"] += 1
+                self.__memory.put(key, arrays)
+                return arrays
+        self.__misses += 1
+        return None
+
+    def put(self, key, arrays):
+        self.__memory.put(key, arrays)
+        if self.__disk is not None:
+            self.__disk.put(key, arrays)
+
+    def trace(self, sim, source, chunk_size=65536):
+        """
+        Final state of the rays of a source traced through a Simulation(), from the cache when the same system
+        has traced the same source before. The source itself is never modified.
+        Return a RayBundle() holding one vertex, the final position, per ray.
+        """
+        name = key(sim, source)
+        arrays = self.get(name)
+        if arrays is None:
+            if isinstance(source, rays.RayBundle):
+                source = rays.RayBundle(source.p(), source.k(), source.freq(), wavelength=source.wavelength(), dtype=source.dtype())
+            chunks = list(sim.propagate_iter(source, chunk_size))
+            arrays = {"p": np.concatenate([chunk.p() for chunk in chunks]).reshape(-1, 3),
+                      "k": np.concatenate([chunk.k() for chunk in chunks]).reshape(-1, 3),
+                      "freq": np.concatenate([chunk.freq() for chunk in chunks]),
+                      "wavelength": np.concatenate([chunk.wavelength() for chunk in chunks]),
+                      "status": np.concatenate([chunk.status() for chunk in chunks]).astype(np.int8),
+                      "count": np.concatenate([chunk.count() for chunk in chunks])}
+            self.put(name, arrays)
+        return rays.RayBundle.frombuffers(arrays["p"].copy()[:, np.newaxis], np.ones(len(arrays["p"]), dtype=int), arrays["k"].copy(),
+                                          arrays["freq"].copy(), arrays["wavelength"].copy(), arrays["status"].copy())
+
+    def stats(self):
+        """
+        Hit and miss counters of the cache and the state of its tiers
+        """
+        lookups = sum(self.__hits.values()) + self.__misses
+        stats = {"hits": dict(self.__hits), "misses": self.__misses, "hitrate": sum(self.__hits.values()) / lookups if lookups else float(0),
+                 "memory": {"entries": len(self.__memory), "bytes": self.__memory.size(), "evictions": self.__memory.evictions()}}
+        if self.__disk is not None:
+            stats["disk"] = {"entries": len(self.__disk), "bytes": self.__disk.size(), "evictions": self.__disk.evictions()}
+        return stats
+
+    def __repr__(self):
+        return "%s(memory=%s, disk=%s)" % ("TraceCache", self.__memory, self.__disk)
@@ -6,47 +6,102 @@ Created on Wed Nov  4 05:15:07 2020
 @author: tikantsoi
 
 Carry out 3D and 2D rendering
+Every ray bundle is drawn with a single matplotlib call, given a filename the plot is saved without opening a window.
 """
 
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.mplot3d import axes3d
-                
-def render3d(sim, title, x1, x2, y1, y2):
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+import analysis
+
+def figure(filename=None):
+    """
+    A pyplot figure, or a figure detached from pyplot when it is only saved to a file
+    """
+    if filename is None:
+        return plt.figure()
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+def finish(fig, filename=None):
+    """
+    Show the figure, or save it to filename
+    """
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename)
+
+def paths(source, maxrays=None):
+    """
+    Vertex histories of the rays of a Simulation(), a RayBundle() or a tracefile.TraceFile(), each an (M, 3) array.
+    Only maxrays rays, evenly spread through every bundle, are returned when given.
+    """
+    if hasattr(source, "bundles"): #Simulation()
+        bundles = list(source.bundles())
+        loose = [ray.vertices() for ray in source.loose()]
+    else:
+        bundles, loose = [source], []
+    total = len(loose) + sum(len(bundle) for bundle in bundles)
+    fraction = 1 if maxrays is None or total <= maxrays else maxrays / total
+    histories = loose[::max(int(round(1 / fraction)), 1)]
+    for bundle in bundles:
+        N = len(bundle)
+        index = np.unique(np.linspace(0, N - 1, max(int(N * fraction), 1)).astype(int)) if N else []
+        histories.extend(bundle.history(i) for i in index)
+    return histories
+
+def render3d(sim, title, x1, x2, y1, y2, maxrays=2000, filename=None):
     """
     Create a 3D plot of all the light rays
+    At most maxrays representative rays are drawn, None draws them all.
     """
-    fig = plt.figure()
+    fig = figure(filename)
     ax=fig.add_subplot(111, projection='3d')
     ax.title.set_text(title)
-        
-    for ray in sim.rays():
-        X = [point[0] for point in ray.vertices()]
-        Y = [point[1] for point in ray.vertices()]
-        Z = [point[2] for point in ray.vertices()]
-        ax.plot3D(X,Y,Z)
-        
-    plt.grid() 
-    plt.xlim(x1, x2)
-    plt.ylim(y1, y2)
+
+    histories = paths(sim, maxrays)
+    colours = plt.get_cmap("tab10")(np.arange(len(histories)) % 10)
+    ax.add_collection3d(Line3DCollection(histories, colors=colours))
+    if histories:
+        z = np.concatenate([vertices[:, 2] for vertices in histories])
+        ax.set_zlim(z.min(), z.max())
+
+    ax.grid()
+    ax.set_xlim(x1, x2)
+    ax.set_ylim(y1, y2)
     ax.set_xlabel("x (mm)")
     ax.set_ylabel("y (mm)")
     ax.set_zlabel("z (mm)")
-    plt.show()
-    
-def render2d(sim, title, x1, x2, y1, y2):
-    fig, ax = plt.subplots()
+    finish(fig, filename)
+
+def render2d(sim, title, x1, x2, y1, y2, mode="scatter", bins=512, filename=None):
+    """
+    Create the spot diagram of the rays still alive.
+    mode="scatter" draws every spot in one call, mode="raster" draws a 2D histogram of bins x bins pixels for millions of spots.
+    """
+    fig = figure(filename)
+    ax = fig.add_subplot(111)
     ax.set_aspect('equal')
     ax.title.set_text(title)
-    
-    for ray in sim.rays():
-        X = [ray.p()[0]]
-        Y = [ray.p()[1]]
-        ax.scatter(X,Y)
-    
-    plt.grid()
-    plt.xlim(x1, x2)
-    plt.ylim(y1, y2)
-    plt.xlabel("x (mm)")
-    plt.ylabel("y (mm)")
-    plt.show()
-    
+
+    points = analysis.spot(sim)
+    if mode == "scatter":
+        ax.scatter(points[:, 0], points[:, 1], s=4)
+    elif mode == "raster":
+        H, xedges, yedges = np.histogram2d(points[:, 0], points[:, 1], bins=bins, range=[[x1, x2], [y1, y2]])
+        image = ax.imshow(np.ma.masked_equal(H.T, 0), origin="lower", extent=(x1, x2, y1, y2), interpolation="nearest", cmap="viridis")
+        fig.colorbar(image, ax=ax, label="rays")
+    else:
+        raise ValueError("mode must be 'scatter' or 'raster'.")
+
+    ax.grid()
+    ax.set_xlim(x1, x2)
+    ax.set_ylim(y1, y2)
+    ax.set_xlabel("x (mm)")
+    ax.set_ylabel("y (mm)")
+    finish(fig, filename)
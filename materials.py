@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Provide optical media with wavelength dependent refractive indices.
+Wavelengths are given in micrometres.
+"""
+
+import numpy as np
+
+D_LINE = 0.5875618 #helium d line, the wavelength at which catalogue indices are quoted
+
+class Medium:
+    """
+    Base class for all media.
+    Indices are cached per distinct wavelength, so a table for a bundle is only evaluated once per wavelength.
+    """
+
+    def __init__(self):
+        self.__cache = {}
+
+    def dispersive(self):
+        return True
+
+    def n(self, wavelength):
+        "refractive index at the wavelengths"
+        raise NotImplementedError()
+
+    def params(self):
+        """
+        Type and coefficients of the medium at full precision, the keyword arguments which rebuild it
+        """
+        raise NotImplementedError()
+
+    def index(self, wavelength=D_LINE):
+        """
+        Refractive index at a single wavelength, from the cache.
+        """
+        wavelength = float(wavelength)
+        if wavelength not in self.__cache:
+            self.__cache[wavelength] = float(self.n(np.array([wavelength]))[0])
+        return self.__cache[wavelength]
+
+    def table(self, wavelengths):
+        """
+        Refractive indices at an array of distinct wavelengths, from the cache.
+        """
+        return np.array([self.index(wavelength) for wavelength in np.ravel(wavelengths)])
+
+class Constant(Medium):
+    """
+    A medium without dispersion.
+    """
+
+    def __init__(self, n=float(1)):
+        super().__init__()
+        self.__n = float(n)
+
+    def dispersive(self):
+        return False
+
+    def n(self, wavelength):
+        return np.full(np.shape(wavelength), self.__n)
+
+    def index(self, wavelength=D_LINE):
+        return self.__n
+
+    def params(self):
+        return {"type": "Constant", "n": self.__n}
+
+    def __repr__(self):
+        return "%s(n=%g)" % ("Constant", self.__n)
+
+class Sellmeier(Medium):
+    """
+    A medium following the Sellmeier equation n^2 = 1 + sum B * wavelength^2 / (wavelength^2 - C).
+    """
+
+    def __init__(self, B, C):
+        super().__init__()
+        self.__B = tuple(float(b) for b in B)
+        self.__C = tuple(float(c) for c in C)
+        if len(self.__B) != len(self.__C):
+            raise ValueError("B and C need the same number of terms.")
+
+    def n(self, wavelength):
+        w2 = np.asarray(wavelength, dtype=float) ** 2
+        return np.sqrt(1 + sum(b * w2 / (w2 - c) for b, c in zip(self.__B, self.__C)))
+
+    def params(self):
+        return {"type": "Sellmeier", "B": list(self.__B), "C": list(self.__C)}
+
+    def __repr__(self):
+        return "%s(B=%s, C=%s)" % ("Sellmeier", self.__B, self.__C)
+
+class Cauchy(Medium):
+    """
+    A medium following Cauchy's equation n = A + B / wavelength^2 + C / wavelength^4.
+    """
+
+    def __init__(self, A, B=float(0), C=float(0)):
+        super().__init__()
+        self.__A = float(A)
+        self.__B = float(B)
+        self.__C = float(C)
+
+    def n(self, wavelength):
+        w2 = np.asarray(wavelength, dtype=float) ** 2
+        return self.__A + self.__B / w2 + self.__C / (w2 * w2)
+
+    def params(self):
+        return {"type": "Cauchy", "A": self.__A, "B": self.__B, "C": self.__C}
+
+    def __repr__(self):
+        return "%s(A=%g, B=%g, C=%g)" % ("Cauchy", self.__A, self.__B, self.__C)
+
+def medium(n):
+    """
+    Turn a refractive index into a Constant() medium, media are returned unchanged.
+    """
+    return n if isinstance(n, Medium) else Constant(n)
+
+BK7 = Sellmeier((1.03961212, 0.231792344, 1.01046945), (0.00600069867, 0.0200179144, 103.560653))
@@ -8,32 +8,311 @@ Created on Thu Oct 22 17:41:18 2020
 Contain objects that are able to reflect / refract and detect light rays.
 """
 
+from collections import namedtuple
 import numpy as np
 import utils as ut
 import rays
+import materials
+
+SphereConstants = namedtuple("SphereConstants", ["pos", "centre", "curvrad", "curvrad2", "sign", "aperad2", "ratio", "critical", "mode"])
+SphereConstants.__doc__ = """
+Precomputed constants of a SphericalRefraction(): the sign orients the normals, ratio is n1 / n2, critical is n2 / n1
+and mode is the interaction of the rays with the surface, see interact().
+"""
+
+PlaneConstants = namedtuple("PlaneConstants", ["pos", "normal", "width", "height", "ratio", "critical", "mode"])
+PlaneConstants.__doc__ = """
+Precomputed constants of a Plane() or an OutputPlane().
+"""
+
+REFRACT = "refract" #Snell's law, rays undergoing total internal reflection are terminated
+REFLECT = "reflect" #every ray is reflected, a mirror
+TIR = "tir" #Snell's law, rays undergoing total internal reflection are reflected and carry on
+MODES = (REFRACT, REFLECT, TIR)
+
+EPSILON = 1e-9 #mm, in non-sequential tracing hits closer than this to the start of a ray are the surface it left
+EPSILON32 = 1e-3 #mm, the same for rays in float32, whose positions are only good to about 1e-7 of their size
+
+def epsilon(p):
+    """
+    The EPSILON of the precision of the positions
+    """
+    return EPSILON32 if p.dtype == np.float32 else EPSILON
+
+def frozen(vec):
+    """
+    A read-only copy of a vector, None is kept
+    """
+    if vec is None:
+        return None
+    vec = ut.vec(vec)
+    vec.flags.writeable = False
+    return vec
+
+def cast(constants, dtype):
+    """
+    Compiled constants in the precision of the rays, so the batch kernels are not promoted to float64.
+    Python numbers and None are kept, numpy arrays and floats are converted.
+    """
+    dtype = np.dtype(dtype)
+    return type(constants)(*(value.astype(dtype) if isinstance(value, np.ndarray) and value.dtype.kind == "f"
+                             else dtype.type(value) if isinstance(value, np.floating) else value for value in constants))
+
+def sphere_intercept(p, khat, centre, curvrad, curvrad2=None):
+    """
+    Batch version of SphericalRefraction.intercept() for (N, 3) positions and unit directions, rays may travel either way along z.
+    The centre and curvature radius may be given per ray. Rays without a valid intercept give NaN.
+    """
+    if curvrad2 is None:
+        curvrad2 = curvrad * curvrad
+    r = p - centre
+    rdotkhat = ut.dots(r, khat)
+    insidesqrt = rdotkhat * rdotkhat - (ut.dots(r, r) - curvrad2)
+    with np.errstate(invalid='ignore'):
+        sqrt = np.sqrt(insidesqrt) #NaN where there is no valid intercept
+    l_1 = - rdotkhat + sqrt
+    l_2 = - rdotkhat - sqrt
+    intercept = np.where(curvrad * khat[..., 2] > 0, np.minimum(l_1, l_2), np.maximum(l_1, l_2)) #the cap is met first going forwards, last going backwards
+    return np.where(rdotkhat == 0, l_1, intercept) #orthogonal so only one intercept
+
+def plane_intercept(p, khat, pos, normal):
+    """
+    Batch version of Plane.intercept(), rays parallel to the plane give NaN.
+    """
+    normaldotkhat = ut.dots(khat, normal)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intercept = ut.dots(pos - p, normal) / normaldotkhat
+    return np.where(normaldotkhat != 0, intercept, np.nan)
+
+def radial2(points, pos):
+    """
+    Squared distances of the points from the axis of the element
+    """
+    d = points - pos
+    return d[..., 0] * d[..., 0] + d[..., 1] * d[..., 1]
+
+def outside_aperture(points, pos, aperad):
+    """
+    Mask of the (N, 3) points further from the axis of the element than the aperture radius.
+    """
+    return radial2(points, pos) > aperad * aperad
+
+def outside_rectangle(points, pos, width, height):
+    """
+    Mask of the (N, 3) points outside the rectangle spanned by the half-width and half-height vectors, a None side is unbounded.
+    """
+    d = points - pos
+    outside = np.zeros(len(d), dtype=bool)
+    for edge in (width, height):
+        if edge is not None:
+            outside |= np.abs(ut.dots(d, edge)) > edge.dot(edge)
+    return outside
+
+def landing(p, khat, intercept, outside):
+    """
+    Move the rays by intercept along khat and classify them.
+    Rays without an intercept (NaN) are MISSED, rays landing where outside() is True are CLIPPED, both stay where they are.
+    Return the new positions and the status of every ray.
+    """
+    newp = p + intercept[:, np.newaxis] * khat
+    status = np.where(np.isnan(intercept), rays.MISSED, rays.ALIVE).astype(np.int8)
+    status[(status == rays.ALIVE) & outside(newp)] = rays.CLIPPED
+    return np.where((status == rays.ALIVE)[:, np.newaxis], newp, p), status
+
+def snell(khat, normal, n1, n2):
+    """
+    Batch version of Snell's law in vector form as used by refraction().
+    Return the new directions and a mask of the rays undergoing total internal reflection, which keep their old direction.
+    """
+    return refract(khat, normal, n1 / n2, n2 / n1)
+
+def refract(khat, normal, ratio, critical):
+    """
+    Snell's law given the index ratio n1 / n2 and the critical sine n2 / n1, see snell().
+    The ratio is taken in the precision of the rays, a Python float or float64 array would promote float32 rays to float64.
+    """
+    ratio = np.asarray(ratio, dtype=khat.dtype)
+    normaldotkhat = ut.dots(normal, khat)
+    sintheta_1 = np.sqrt(np.maximum(1 - normaldotkhat * normaldotkhat, 0))
+    tir = sintheta_1 > critical
+    with np.errstate(invalid='ignore'):
+        normaldotnewkhat = np.sqrt(1 - (ratio * sintheta_1) ** 2)
+    newkhat = np.reshape(ratio, (-1, 1)) * khat + (normaldotnewkhat - ratio * normaldotkhat)[:, np.newaxis] * normal
+    return np.where(tir[:, np.newaxis], khat, newkhat), tir
+
+def refract_either(khat, normal, ratio, critical):
+    """
+    refract() for rays crossing the surface in either direction, rays running against the normal pass from n2 to n1.
+    """
+    forward = ut.dots(normal, khat) >= 0
+    if forward.all(): #the usual case, spare the copies
+        return refract(khat, normal, ratio, critical)
+    normal = np.where(forward[:, np.newaxis], normal, -normal)
+    return refract(khat, normal, np.where(forward, ratio, critical), np.where(forward, critical, ratio))
+
+def mirror(khat, normal):
+    """
+    Batch version of the law of reflection as used by reflection().
+    """
+    normaldotkhat = ut.dots(normal, khat)
+    return khat - 2 * normaldotkhat[:, np.newaxis] * normal
+
+def interact(khat, normal, ratio, critical, mode=REFRACT, either=False):
+    """
+    New directions of the rays meeting a surface in the given mode and the mask of the rays lost to total internal reflection.
+    Refraction, reflection and total internal reflection are decided ray by ray with masks, there is no branching per ray.
+    With either=True the rays may cross the surface in either direction, see refract_either().
+    """
+    if mode == REFLECT:
+        return mirror(khat, normal), np.zeros(len(khat), dtype=bool)
+    newkhat, tir = (refract_either if either else refract)(khat, normal, ratio, critical)
+    if mode == TIR:
+        newkhat[tir] = mirror(khat[tir], normal[tir])
+        tir = np.zeros(len(khat), dtype=bool)
+    return newkhat, tir
+
+def sphere_landing(c, p, khat):
+    """
+    Move the rays onto a compiled spherical surface, return the new positions, the status of every ray and the normals.
+    """
+    intercept = sphere_intercept(p, khat, c.centre, c.curvrad, c.curvrad2)
+    newp, status = landing(p, khat, intercept, lambda points: radial2(points, c.pos) > c.aperad2)
+    return newp, status, c.sign * ut.hats(c.centre - newp)
+
+def plane_landing(c, p, khat):
+    """
+    Move the rays onto a compiled plane, return the new positions and the status of every ray.
+    """
+    intercept = plane_intercept(p, khat, c.pos, c.normal)
+    return landing(p, khat, intercept, lambda points: outside_rectangle(points, c.pos, c.width, c.height))
+
+def sphere_distance(c, p, khat):
+    """
+    Distance along khat to the nearest hit of the rays with a compiled spherical surface, NaN for rays missing it.
+    Both intersections with the sphere are considered, a hit counts when it lies on the cap within the aperture.
+    """
+    r = p - c.centre
+    rdotkhat = ut.dots(r, khat)
+    with np.errstate(invalid='ignore'):
+        sqrt = np.sqrt(rdotkhat * rdotkhat - (ut.dots(r, r) - c.curvrad2))
+    distance = np.full(len(p), np.nan)
+    for l in (- rdotkhat + sqrt, - rdotkhat - sqrt): #far root first so the near one overwrites it
+        points = p + l[:, np.newaxis] * khat
+        oncap = c.sign * (c.centre[2] - points[:, 2]) > 0
+        valid = (l > epsilon(p)) & oncap & (radial2(points, c.pos) <= c.aperad2)
+        distance = np.where(valid, l, distance)
+    return distance
+
+def plane_distance(c, p, khat):
+    """
+    Distance along khat to the hit of the rays with a compiled plane within its dimensions, NaN for rays missing it.
+    """
+    distance = plane_intercept(p, khat, c.pos, c.normal)
+    with np.errstate(invalid='ignore'):
+        valid = distance > epsilon(p)
+    valid[valid] = ~outside_rectangle(p[valid] + distance[valid, np.newaxis] * khat[valid], c.pos, c.width, c.height)
+    return np.where(valid, distance, np.nan)
+
+def refracted(c, khat, k, newp, status, normal):
+    """
+    Refract or reflect the rays which are still alive as the mode of the element says, rays lost to total internal reflection are terminated.
+    """
+    newkhat, tir = interact(khat, normal, c.ratio, c.critical, c.mode, either=True)
+    status[(status == rays.ALIVE) & tir] = rays.TIR
+    return newp, np.where((status == rays.ALIVE)[:, np.newaxis], newkhat, k), status
     
 class OpticalElements:
     """
     Base class for all optical elements.
+    The mode says how rays interact with the element: refract, reflect or tir (refract, reflecting the rays beyond the critical angle).
     """
     
-    def __init__(self, pos=ut.vec([0,0,10]), n1=float(1), n2=float(1.5)):
+    def __init__(self, pos=ut.vec([0,0,10]), n1=float(1), n2=float(1.5), mode=REFRACT):
+        if mode not in MODES:
+            raise ValueError("mode must be one of %s." % (MODES,))
+        self.__mode = mode
         self.__pos = ut.vec(pos)
-        self.__n1 = float(n1)
-        self.__n2 = float(n2)
+        self.__medium1 = materials.medium(n1)
+        self.__medium2 = materials.medium(n2)
+        self.__n1 = self.__medium1.index()
+        self.__n2 = self.__medium2.index()
         
     def pos(self):
             return self.__pos
         
     def n1(self):
+            """
+            Refractive index before the element, at the d line for a dispersive medium
+            """
             return self.__n1
         
     def n2(self):
             return self.__n2
+        
+    def mode(self):
+        return self.__mode
+    
+    def medium1(self):
+        return self.__medium1
+    
+    def medium2(self):
+        return self.__medium2
+    
+    def dispersive(self):
+        return self.__medium1.dispersive() or self.__medium2.dispersive()
+    
+    def indices(self, wavelength):
+        """
+        Refractive indices either side of the element at a wavelength
+        """
+        return self.__medium1.index(wavelength), self.__medium2.index(wavelength)
+        
+    def params(self):
+        """
+        Parameters which rebuild the element as keyword arguments.
+        """
+        n1 = self.__medium1 if self.__medium1.dispersive() else self.__n1
+        n2 = self.__medium2 if self.__medium2.dispersive() else self.__n2
+        return {"pos": self.__pos, "n1": n1, "n2": n2, "mode": self.__mode}
+    
+    def replace(self, **changes):
+        """
+        Return a copy of the element with some of its parameters changed.
+        """
+        params = self.params()
+        params.update(changes)
+        return type(self)(**params)
     
     def propagate_ray(self, ray):
         "propagate a ray through the optical element"
         raise NotImplementedError()
+    
+    def propagate_batch(self, p, k):
+        "propagate (N, 3) arrays of positions and directions through the optical element, return them with the status of every ray"
+        raise NotImplementedError()
+    
+    def compile(self):
+        "constants of the optical element used by propagate_compiled()"
+        raise NotImplementedError()
+    
+    @staticmethod
+    def propagate_compiled(constants, p, k):
+        "propagate_batch() given the constants returned by compile()"
+        raise NotImplementedError()
+    
+    def bounds(self):
+        "lower and upper corners of the axis-aligned box enclosing the element, infinite when it is unbounded"
+        raise NotImplementedError()
+    
+    @staticmethod
+    def distance_compiled(constants, p, khat):
+        "distance along khat to the nearest hit with the element, NaN for rays missing it"
+        raise NotImplementedError()
+    
+    @staticmethod
+    def normal_compiled(constants, points):
+        "unit normals of the element at the points"
+        raise NotImplementedError()
         
     def __repr__(self):
          return "%s(pos=%s, n1=%g, n2=%g)" % ("OpticalElements", self.__pos, self.__n1, self.__n2)
@@ -53,14 +332,32 @@ class SphericalRefraction(OpticalElements):
     - the aperture radius 
     """
 
-    def __init__(self, curv, aperad, *args):
-        super().__init__(*args)
+    def __init__(self, curv, aperad, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.__curv = float(curv)
         if self.__curv == 0:
             raise ValueError("Curvature of the surface is zero.")
         self.__curvrad = 1/ self.__curv
         self.__aperad = float(aperad)
         self.__centre = self.pos() + ut.vec([0,0,self.__curvrad])
+        self.__constants = SphereConstants(frozen(self.pos()), frozen(self.__centre), self.__curvrad, self.__curvrad * self.__curvrad,
+                                           1.0 if self.__curvrad > 0 else -1.0, self.__aperad * self.__aperad, self.n1() / self.n2(), self.n2() / self.n1(),
+                                           self.mode())
+        
+    def curv(self):
+        return self.__curv
+    
+    def curvrad(self):
+        return self.__curvrad
+    
+    def aperad(self):
+        return self.__aperad
+    
+    def centre(self):
+        return self.__centre
+    
+    def params(self):
+        return dict(super().params(), curv=self.__curv, aperad=self.__aperad)
     
     def intercept(self, ray):
         """
@@ -70,37 +367,48 @@ class SphericalRefraction(OpticalElements):
         rdotkhat = r.dot(ray.khat())
         insidesqrt = rdotkhat * rdotkhat - (ut.norm(r) * ut.norm(r) - self.__curvrad * self.__curvrad)
         if insidesqrt < 0:
-            None#no valid intercept
-            return ray.terminated
+            return None #no valid intercept
         sqrt = np.sqrt(insidesqrt)
         l_1 = - rdotkhat + sqrt
         l_2 = - rdotkhat - sqrt
-        #d_aperad = ut.norm(ut.vec([0,self.__aperad,0]) + self.pos() - ray.p()) #distance from the position of the ray to the aperture radius
     
         if abs(rdotkhat) > 0: 
-            if self.__curvrad > 0:
+            if self.__curvrad * ray.khat()[2] > 0: #the cap is met first going forwards
                 intercept = min(l_1, l_2)
-                #if intercept < d_aperad:
                 return intercept
             else:
                 intercept = max(l_1, l_2)
-                #if intercept > d_aperad:
                 return intercept
         else: #rdotkhat = 0
             intercept = l_1 #orthogonal so no only one intercept
             return intercept
             
+    def land(self, ray):
+        """
+        Move the ray onto the surface and return its new position.
+        A ray missing the surface or its aperture is terminated and None is returned, as for a ray terminated before.
+        """
+        if ray.terminated:
+            return None
+        intercept = self.intercept(ray)
+        if intercept is None:
+            ray.terminate(rays.MISSED)
+            return None
+        newp = ray.p() + intercept * ray.khat() 
+        if outside_aperture(newp, self.pos(), self.__aperad):
+            ray.terminate(rays.CLIPPED)
+            return None
+        ray.append(newp)
+        return newp
+            
     def refraction(self, ray):
         """
         Calculate the ray refraction by using the most general Snell's law in vector form.
+        Rays missing the surface or its aperture, or undergoing total internal reflection, are terminated.
         """
-        if self.intercept(ray) == None:
-           return ray.terminated
-        else:
-            pass
-        
-        newp = ray.p() + self.intercept(ray) * ray.khat() 
-        ray.append(newp)
+        newp = self.land(ray)
+        if newp is None:
+            return None
         
         if self.__curvrad > 0:
             normal = ut.hat(self.__centre - newp) 
@@ -108,26 +416,27 @@ class SphericalRefraction(OpticalElements):
             normal = - ut.hat(self.__centre - newp)
        
         normaldotkhat =  normal.dot(ray.khat())
-        sintheta_1 = np.sqrt(1 - normaldotkhat * normaldotkhat)
+        sintheta_1 = np.sqrt(max(1 - normaldotkhat * normaldotkhat, 0)) #rounding can take it below 0 at normal incidence
+        n1, n2 = self.indices(ray.wavelength())
         
-        if sintheta_1 > self.n2() / self.n1(): #total internal reflection
+        if sintheta_1 > n2 / n1: #total internal reflection
+            if self.mode() == TIR:
+                ray.ksetter(ray.khat() - 2 * normaldotkhat * normal)
+                return None
+            ray.terminate(rays.TIR)
             return None
         
-        normaldotnewkhat = np.sqrt(1 - (self.n1() / self.n2() * sintheta_1) ** 2)
-        newkhat = (self.n1() * ray.khat() + (self.n2() * normaldotnewkhat - self.n1() * normaldotnewkhat) * normal) / self.n2() 
+        normaldotnewkhat = np.sqrt(1 - (n1 / n2 * sintheta_1) ** 2)
+        newkhat = (n1 * ray.khat() + (n2 * normaldotnewkhat - n1 * normaldotkhat) * normal) / n2 
         ray.ksetter(newkhat)
         
     def reflection(self, ray):
         """
         Calculate the ray reflection
         """
-        if self.intercept(ray) == None:
-           return ray.terminated
-        else:
-            pass
-        
-        newp = ray.p() + self.intercept(ray) * ray.khat() 
-        ray.append(newp)
+        newp = self.land(ray)
+        if newp is None:
+            return None
         
         if self.__curvrad > 0:
             normal = ut.hat(self.__centre - newp) 
@@ -139,16 +448,77 @@ class SphericalRefraction(OpticalElements):
         ray.ksetter(newkhat)
         
         
-    def propagate_ray(self, ray):
-        self.intercept(ray)
-        self.refraction(ray)
-        
-        
+    def intercept_batch(self, p, k):
+        """
+        Batch version of intercept() for (N, 3) arrays of positions and directions.
+        """
+        return sphere_intercept(p, ut.hats(k), self.__centre, self.__curvrad)
+    
+    def normal_batch(self, points):
+        """
+        Unit normals of the surface at (N, 3) points, oriented as in refraction().
         """
-    def propagate_ray(self, ray): # Use only when studying reflection of rays
-        self.intercept(ray)
-        self.reflection(ray)
+        if self.__curvrad > 0:
+            return ut.hats(self.__centre - points)
+        else:
+            return - ut.hats(self.__centre - points)
+    
+    def refraction_batch(self, p, k):
+        """
+        Batch version of refraction().
+        Return the new positions, the new directions and the status of every ray, see rays.ALIVE.
+        Rays which are MISSED or CLIPPED stay where they are, rays undergoing total internal reflection keep their direction.
+        """
+        return self.propagate_compiled(self.__constants, p, k)
+    
+    def reflection_batch(self, p, k):
+        """
+        Batch version of reflection().
+        """
+        khat = ut.hats(k)
+        newp, status, normal = sphere_landing(self.__constants, p, khat)
+        newk = np.where((status == rays.ALIVE)[:, np.newaxis], mirror(khat, normal), k)
+        return newp, newk, status
+    
+    def compile(self):
+        """
+        Constants used by the batch methods, computed once when the surface is created.
+        """
+        return self.__constants
+    
+    @staticmethod
+    def propagate_compiled(c, p, k):
         """
+        Refract (N, 3) arrays of positions and directions at a compiled surface, see refraction_batch().
+        """
+        khat = ut.hats(k)
+        newp, status, normal = sphere_landing(c, p, khat)
+        return refracted(c, khat, k, newp, status, normal)
+    
+    def bounds(self):
+        """
+        Box enclosing the cap of the sphere inside the aperture.
+        """
+        a = min(self.__aperad, abs(self.__curvrad))
+        sag = self.__curvrad - np.sign(self.__curvrad) * np.sqrt(self.__curvrad * self.__curvrad - a * a)
+        return self.pos() + ut.vec([-a, -a, min(sag, 0)]), self.pos() + ut.vec([a, a, max(sag, 0)])
+    
+    @staticmethod
+    def distance_compiled(c, p, khat):
+        return sphere_distance(c, p, khat)
+    
+    @staticmethod
+    def normal_compiled(c, points):
+        return c.sign * ut.hats(c.centre - points)
+        
+    def propagate_ray(self, ray):
+        if self.mode() == REFLECT:
+            self.reflection(ray)
+        else:
+            self.refraction(ray)
+        
+    def propagate_batch(self, p, k):
+        return self.refraction_batch(p, k)
         
     def __repr__(self):
         return "%s(curv=%g, curvrad=%g, aperad=%g, n1=%g, n2=%g, pos=%s, centre=%s)" % ("SphericalRefraction", self.__curv, self.__curvrad, self.__aperad, self.n1(), self.n2(), self.pos(), self.__centre)
@@ -157,14 +527,17 @@ class Plane(OpticalElements):
     """
     A refracting planar surface.
     The surface has a unit normal vector, as well as dimensions which are given in vectors.
+    The width and height vectors run from the position to the edges, a dimension given as None is unbounded.
     """
-    def __init__(self, *args, normal=ut.vec([0,0,1]), width=ut.vec([2.5,0,0]), height=ut.vec([0,2.5,0])):
-        super().__init__(*args)
+    def __init__(self, *args, normal=ut.vec([0,0,1]), width=ut.vec([2.5,0,0]), height=ut.vec([0,2.5,0]), **kwargs):
+        super().__init__(*args, **kwargs)
         self.__normal = ut.vec(normal)
-        self.__width = ut.vec(width)
-        self.__height = ut.vec(height)
-        if not width.dot(height) == 0: 
+        self.__width = None if width is None else ut.vec(width)
+        self.__height = None if height is None else ut.vec(height)
+        if self.__width is not None and self.__height is not None and not self.__width.dot(self.__height) == 0: 
             raise ValueError("Not an orthogonal plane.")
+        self.__constants = PlaneConstants(frozen(self.pos()), frozen(self.__normal), frozen(self.__width), frozen(self.__height),
+                                          self.n1() / self.n2(), self.n2() / self.n1(), self.mode())
             
     def normal(self):
         return self.__normal
@@ -174,34 +547,104 @@ class Plane(OpticalElements):
     
     def height(self):
         return self.__height
+    
+    def params(self):
+        return dict(super().params(), normal=self.__normal, width=self.__width, height=self.__height)
         
     def intercept(self, ray):    
+        if ray.terminated:
+            return None
         normaldotkhat = self.__normal.dot(ray.khat())
         if abs(normaldotkhat) > 0:
-            intercept = ut.norm((self.pos() - ray.p()) / normaldotkhat)
+            intercept = (self.pos() - ray.p()).dot(self.__normal) / normaldotkhat
             newp = ray.p() + intercept * ray.khat()
+            if outside_rectangle(newp[np.newaxis], self.pos(), self.__width, self.__height)[0]:
+                ray.terminate(rays.CLIPPED)
+                return None
             ray.append(newp)
             return intercept
         else:
+            ray.terminate(rays.MISSED)
             return None
         
-        if intercept == None:
-            return ray.terminated
-        
     def refraction(self, ray): 
+        if ray.terminated:
+            return None
         normaldotkhat = self.__normal.dot(ray.khat())
-        sintheta_1 = np.sqrt(1 - normaldotkhat * normaldotkhat)
+        sintheta_1 = np.sqrt(max(1 - normaldotkhat * normaldotkhat, 0)) #rounding can take it below 0 at normal incidence
+        if self.mode() == REFLECT:
+            ray.ksetter(ray.khat() - 2 * normaldotkhat * self.__normal)
+            return None
+        n1, n2 = self.indices(ray.wavelength())
         
-        if sintheta_1 > self.n2() / self.n1(): #total internal reflection
+        if sintheta_1 > n2 / n1: #total internal reflection
+            if self.mode() == TIR:
+                ray.ksetter(ray.khat() - 2 * normaldotkhat * self.__normal)
+                return None
+            ray.terminate(rays.TIR)
             return None
         
-        normaldotnewkhat = np.sqrt(1 - (self.n1() / self.n2() * sintheta_1) ** 2)
-        newkhat = (self.n1() * ray.khat() + (self.n2() * normaldotnewkhat - self.n1() * normaldotnewkhat) * self.__normal) / self.n2() 
+        normaldotnewkhat = np.sqrt(1 - (n1 / n2 * sintheta_1) ** 2)
+        newkhat = (n1 * ray.khat() + (n2 * normaldotnewkhat - n1 * normaldotkhat) * self.__normal) / n2 
         ray.ksetter(newkhat)
     
+    def intercept_batch(self, p, k):
+        """
+        Batch version of intercept(), the positions are not updated.
+        """
+        return plane_intercept(p, ut.hats(k), self.pos(), self.__normal)
+    
+    def refraction_batch(self, p, k):
+        """
+        Batch version of intercept() followed by refraction().
+        Return the new positions, the new directions and the status of every ray, see rays.ALIVE.
+        """
+        return self.propagate_compiled(self.__constants, p, k)
+    
+    def landing_batch(self, p, khat):
+        """
+        Move the rays onto the plane, return the new positions and the status of every ray.
+        """
+        return plane_landing(self.__constants, p, khat)
+    
+    def compile(self):
+        """
+        Constants used by the batch methods, computed once when the plane is created.
+        """
+        return self.__constants
+    
+    @staticmethod
+    def propagate_compiled(c, p, k):
+        """
+        Refract (N, 3) arrays of positions and directions at a compiled plane, see refraction_batch().
+        """
+        khat = ut.hats(k)
+        newp, status = plane_landing(c, p, khat)
+        return refracted(c, khat, k, newp, status, np.broadcast_to(c.normal, p.shape))
+    
+    def bounds(self):
+        """
+        Box enclosing the corners of the plane, infinite when a dimension is unbounded.
+        """
+        if self.__width is None or self.__height is None:
+            return np.full(3, -np.inf), np.full(3, np.inf)
+        corners = np.array([self.pos() + i * self.__width + j * self.__height for i in (-1, 1) for j in (-1, 1)])
+        return corners.min(axis=0), corners.max(axis=0)
+    
+    @staticmethod
+    def distance_compiled(c, p, khat):
+        return plane_distance(c, p, khat)
+    
+    @staticmethod
+    def normal_compiled(c, points):
+        return np.broadcast_to(c.normal, points.shape)
+    
     def propagate_ray(self, ray):
-        self.intercept(ray)
-        self.refraction(ray)
+        if self.intercept(ray) is not None:
+            self.refraction(ray)
+        
+    def propagate_batch(self, p, k):
+        return self.refraction_batch(p, k)
         
     def __repr__(self):
         return "%s(normal=%s, width=%s, height=%s, n1=%g, n2=%g, pos=%s,)" % ("Plane", self.__normal, self.__width, self.__height, self.n1(), self.n2(), self.pos())
@@ -209,31 +652,52 @@ class Plane(OpticalElements):
 class OutputPlane(Plane):
     """
     A plane where the light rays land.
-    No reflection / refraction.
+    No reflection / refraction. Unlike Plane() it is unbounded unless a width or height is given.
     """
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, width=None, height=None, **kwargs):
+        super().__init__(*args, width=width, height=height, **kwargs)
         
     def refraction(self, ray):
         raise NotImplementedError()
         
+    def refraction_batch(self, p, k):
+        raise NotImplementedError()
+        
     def propagate_ray(self, ray):
         return self.intercept(ray)
+    
+    def propagate_batch(self, p, k):
+        """
+        Move the rays onto the plane, the directions are unchanged.
+        """
+        return self.propagate_compiled(self.compile(), p, k)
+    
+    @staticmethod
+    def propagate_compiled(c, p, k):
+        newp, status = plane_landing(c, p, ut.hats(k))
+        return newp, k, status
         
     def __repr__(self):
         return "%s(normal=%s, width=%s, height=%s, n1=%g, n2=%g, pos=%s,)" % ("OutputPlane", self.normal(), self.width(), self.height(), self.n1(), self.n2(), self.pos())
 
-                
-
-    
-    
-        
-     
-            
+class SphericalMirror(SphericalRefraction):
+    """
+    A spherical mirror, every ray landing within the aperture is reflected and stays in the medium n1, n2 is not used.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs["mode"] = REFLECT
+        super().__init__(*args, **kwargs)
         
-            
+    def __repr__(self):
+        return "%s(curv=%g, curvrad=%g, aperad=%g, n1=%g, pos=%s, centre=%s)" % ("SphericalMirror", self.curv(), self.curvrad(), self.aperad(), self.n1(), self.pos(), self.centre())
     
-            
+class PlaneMirror(Plane):
+    """
+    A planar mirror, every ray landing within its dimensions is reflected and stays in the medium n1, n2 is not used.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs["mode"] = REFLECT
+        super().__init__(*args, **kwargs)
         
-    
-   
\ No newline at end of file
+    def __repr__(self):
+        return "%s(normal=%s, width=%s, height=%s, n1=%g, pos=%s,)" % ("PlaneMirror", self.normal(), self.width(), self.height(), self.n1(), self.pos())
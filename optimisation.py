@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Provide a lens-design optimiser minimising the RMS spot radius.
+Whole populations of candidate designs are traced at once by broadcasting the element parameters along a design axis.
+"""
+
+import numpy as np
+import utils as ut
+import opticalelements
+import paraxial
+import analysis
+
+NAMES = ("curv", "z", "n1", "n2")
+
+def modified(elem, name, value):
+    """
+    Copy of an element with one parameter changed, name being z, the position on the axis, or any parameter of the element.
+    """
+    if name == "z":
+        return elem.replace(pos=elem.pos() + ut.vec([0, 0, value - elem.pos()[2]]))
+    return elem.replace(**{name: value})
+
+def trace_designs(elements, values, p, k):
+    """
+    Trace the rays p, k through D designs of the system in a single vectorised pass.
+    values maps (element index, name) to (D,) arrays, name being one of curv, z, n1 or n2,
+    the other parameters are those of the elements.
+    Return the final positions and directions with shape (D, N, 3) and a (D, N) mask of the rays which passed every element,
+    rays are lost when they miss an element or its aperture, or to total internal reflection, mirrors reflect them.
+    """
+    D = len(next(iter(values.values()))) if values else 1
+    N = len(p)
+    p = np.tile(p, (D, 1))
+    k = np.tile(k, (D, 1))
+    alive = np.ones(D * N, dtype=bool)
+    for i, elem in enumerate(elements):
+        params = elem.params()
+        def param(name):
+            value = values.get((i, name))
+            if value is None:
+                return getattr(elem, name)() if name in ("n1", "n2") else params[name] #d line index of a dispersive medium
+            return np.repeat(np.asarray(value, dtype=float), N)
+        z = param("z") if (i, "z") in values else params["pos"][2]
+        pos = params["pos"] + np.multiply.outer(z - params["pos"][2], ut.vec([0,0,1]))
+        khat = ut.hats(k)
+        if isinstance(elem, opticalelements.SphericalRefraction):
+            curvrad = 1 / np.asarray(param("curv"), dtype=float)
+            centre = pos + np.multiply.outer(curvrad, ut.vec([0,0,1]))
+            intercept = opticalelements.sphere_intercept(p, khat, centre, curvrad)
+            newp = p + intercept[:, np.newaxis] * khat
+            normal = np.reshape(np.where(curvrad > 0, 1, -1), (-1, 1)) * ut.hats(centre - newp)
+            outside = opticalelements.outside_aperture(newp, pos, elem.aperad())
+        elif isinstance(elem, opticalelements.Plane):
+            intercept = opticalelements.plane_intercept(p, khat, pos, elem.normal())
+            newp = p + intercept[:, np.newaxis] * khat
+            normal = np.broadcast_to(elem.normal(), p.shape)
+            outside = opticalelements.outside_rectangle(newp, pos, elem.width(), elem.height())
+        else:
+            raise TypeError("Cannot trace %s in a batch of designs." % type(elem).__name__)
+        hit = ~np.isnan(intercept) & ~outside
+        p = np.where(hit[:, np.newaxis], newp, p)
+        alive &= hit
+        if not isinstance(elem, opticalelements.OutputPlane):
+            n1, n2 = param("n1"), param("n2")
+            newk, tir = opticalelements.interact(khat, normal, n1 / n2, n2 / n1, elem.mode(), either=True)
+            k = np.where((hit & ~tir)[:, np.newaxis], newk, k)
+            alive &= ~tir
+    return p.reshape(D, N, 3), k.reshape(D, N, 3), alive.reshape(D, N)
+
+def design_rms(p, alive):
+    """
+    RMS spot radius about the centroid of each design from (D, N, 3) positions, counting only the rays alive.
+    """
+    w = alive.astype(float)
+    n = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xy = np.where(alive[..., np.newaxis], p[..., :2], 0)
+        mean = xy.sum(axis=1) / n[:, np.newaxis]
+        diff = (xy - mean[:, np.newaxis]) * w[..., np.newaxis]
+        return np.sqrt(np.sum(diff * diff, axis=(1, 2)) / n)
+
+def design_best_focus(p, k, alive):
+    """
+    Position and RMS spot radius of the best focus of each design from the (D, N, 3) rays leaving the last surface,
+    see analysis.best_focus().
+    """
+    return analysis.best_focus(analysis.focus_moments(p, k, alive))
+
+class BatchOptimiser:
+    """
+    Minimise the RMS spot radius of a system over element parameters.
+    The parameters are given as {(element index, name): (low, high)}, name being one of curv, z, n1 or n2.
+    With focus='output' the spot is measured on the final OutputPlane(), with focus='best' at the best focus of every design.
+    Designs losing more than maxloss of the rays are rejected. At most maxrays rays are traced in one pass.
+    """
+
+    def __init__(self, sim, bundle, parameters, focus="output", maxloss=0.0, maxrays=2 ** 22):
+        self.__elements = list(sim.elements())
+        self.__p = np.array(bundle.p())
+        self.__k = np.array(bundle.k())
+        self.__keys = list(parameters)
+        self.__bounds = np.array([parameters[key] for key in self.__keys], dtype=float).reshape(-1, 2)
+        if focus not in ("output", "best"):
+            raise ValueError("focus must be 'output' or 'best'.")
+        self.__focus = focus
+        self.__maxloss = float(maxloss)
+        self.__maxrays = int(maxrays)
+        for index, name in self.__keys:
+            if name not in NAMES:
+                raise ValueError("Unknown parameter %s." % name)
+            if name == "curv" and not isinstance(self.__elements[index], opticalelements.SphericalRefraction):
+                raise ValueError("Element %d has no curvature." % index)
+        if focus == "output" and not isinstance(self.__elements[-1], opticalelements.OutputPlane):
+            raise ValueError("The system must end with an OutputPlane().")
+
+    def keys(self):
+        return self.__keys
+
+    def bounds(self):
+        return self.__bounds
+
+    def initial(self):
+        """
+        Current parameters of the elements, except that with focus='output' the final OutputPlane() starts at the paraxial focus
+        of the system, see paraxial.py, when it is known.
+        """
+        values = []
+        for index, name in self.__keys:
+            elem = self.__elements[index]
+            values.append(elem.pos()[2] if name == "z" else getattr(elem, name)())
+        if (len(self.__elements) - 1, "z") in self.__keys and self.__focus == "output":
+            focus = paraxial.focus(self.__elements)
+            if np.isfinite(focus):
+                values[self.__keys.index((len(self.__elements) - 1, "z"))] = focus
+        return np.array(values, dtype=float)
+
+    def evaluate(self, designs):
+        """
+        RMS spot radius of each row of the (D, P) array of designs, traced in as few passes as maxrays allows.
+        """
+        designs = np.atleast_2d(np.asarray(designs, dtype=float))
+        elements = self.__elements
+        if self.__focus == "best":
+            while elements and isinstance(elements[-1], opticalelements.OutputPlane):
+                elements = elements[:-1]
+        step = max(self.__maxrays // max(len(self.__p), 1), 1)
+        result = np.empty(len(designs))
+        for start in range(0, len(designs), step):
+            block = designs[start:start + step]
+            values = {key: block[:, j] for j, key in enumerate(self.__keys)}
+            if not values:
+                values = {(0, "n1"): np.full(len(block), elements[0].n1())}
+            p, k, alive = trace_designs(elements, values, self.__p, self.__k)
+            if self.__focus == "best":
+                rms = design_best_focus(p, k, alive)[1]
+            else:
+                rms = design_rms(p, alive)
+            lost = 1 - alive.mean(axis=1)
+            result[start:start + step] = np.where((lost <= self.__maxloss) & np.isfinite(rms), rms, np.inf)
+        return result
+
+    def optimise(self, population=1000, generations=20, elite=0.1, seed=None):
+        """
+        Cross-entropy search: every generation a population of designs is sampled around the current mean, evaluated in one batch,
+        and the mean and spread are refitted to the best fraction elite of the population.
+        Return the best parameters, its RMS spot radius, the rebuilt elements and the best RMS radius of every generation.
+        """
+        rng = np.random.default_rng(seed)
+        low, high = self.__bounds[:, 0], self.__bounds[:, 1]
+        mean = np.clip(self.initial(), low, high)
+        std = (high - low) / 4
+        nelite = max(int(population * elite), 1)
+        best, bestrms, history = mean, self.evaluate(mean)[0], []
+        for generation in range(generations):
+            designs = np.clip(rng.normal(mean, std, (population, len(mean))), low, high)
+            rms = self.evaluate(designs)
+            order = np.argsort(rms)[:nelite]
+            if rms[order[0]] < bestrms:
+                best, bestrms = designs[order[0]], rms[order[0]]
+            history.append(bestrms)
+            if np.isfinite(rms[order]).any():
+                mean = designs[order].mean(axis=0)
+                std = designs[order].std(axis=0) + 1e-12 * (high - low)
+        return {"parameters": dict(zip(self.__keys, best.tolist())), "rms": float(bestrms),
+                "elements": self.elements(best), "history": np.array(history)}
+
+    def elements(self, design):
+        """
+        Rebuild the elements of a design.
+        """
+        elements = list(self.__elements)
+        for (index, name), value in zip(self.__keys, design):
+            elements[index] = modified(elements[index], name, value)
+        return elements
+
+    def __repr__(self):
+        return "%s(parameters=%s, focus=%s)" % ("BatchOptimiser", self.__keys, self.__focus)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Paraxial optics of a system of elements from its 2x2 ray-transfer (ABCD) matrix, without tracing any ray.
+Rays are given by their height y and reduced angle n u, so a surface of curvature c between n1 and n2 has the power (n2 - n1) c
+and a gap of length d in a medium n the reduced thickness d / n.
+A mirror is a surface into the index -n1, so after an odd number of reflections the image-side index is negative
+and distances along z run backwards.
+"""
+
+import numpy as np
+import materials
+import opticalelements
+
+TOLERANCE = 1e-12 #offsets from the axis taken as zero
+
+def refraction(power):
+    return np.array([[1, 0], [- power, 1]], dtype=float)
+
+def transfer(d, n):
+    return np.array([[1, d / n], [0, 1]], dtype=float)
+
+def axial(elem):
+    """
+    Whether an element is centred on the z axis and perpendicular to it
+    """
+    x, y = elem.pos()[:2]
+    if abs(x) > TOLERANCE or abs(y) > TOLERANCE:
+        return False
+    if isinstance(elem, opticalelements.Plane):
+        x, y = elem.normal()[:2]
+        return abs(x) <= TOLERANCE and abs(y) <= TOLERANCE
+    return True
+
+class ParaxialSystem:
+    """
+    The paraxial properties of the refracting surfaces of a system at one wavelength, OutputPlane() elements are left out.
+    Positions are z coordinates, the focal lengths are those of the image side (n' / power) and the object side (- n / power).
+    The surfaces are taken in list order, as in sequential tracing, and must be rotationally symmetric about the z axis.
+    """
+
+    def __init__(self, elements, wavelength=materials.D_LINE):
+        surfaces = [elem for elem in elements if not isinstance(elem, opticalelements.OutputPlane)]
+        if not surfaces:
+            raise ValueError("The system has no refracting surfaces.")
+        if not all(axial(elem) for elem in surfaces):
+            raise ValueError("The paraxial matrix needs surfaces centred on and perpendicular to the z axis.")
+        A, B, C, D = 1.0, 0.0, 0.0, 1.0 #the products are written out, 2x2 numpy products cost more than the arithmetic
+        sign = 1.0
+        for i, elem in enumerate(surfaces):
+            n1, n2 = (float(n) for n in elem.indices(wavelength))
+            n1 = sign * n1
+            if elem.mode() == opticalelements.REFLECT: #a mirror refracts into the index -n1
+                n2, sign = - n1, - sign
+            else:
+                n2 = sign * n2
+            z = float(elem.pos()[2])
+            if i > 0:
+                t = (z - previous) / n1
+                A, B = A + t * C, B + t * D
+            power = (n2 - n1) * elem.curv() if isinstance(elem, opticalelements.SphericalRefraction) else 0.0
+            C, D = C - power * A, D - power * B
+            previous = z
+            if i == 0:
+                self.__n = n1
+        self.__matrix = np.array([[A, B], [C, D]])
+        self.__wavelength = float(wavelength)
+        self.__first, self.__last = float(surfaces[0].pos()[2]), previous
+        self.__nprime = n2
+
+    def matrix(self):
+        """
+        The ABCD matrix from the first to the last surface
+        """
+        return self.__matrix
+
+    def wavelength(self):
+        return self.__wavelength
+
+    def power(self):
+        return - self.__matrix[1, 0]
+
+    def efl(self):
+        """
+        Effective focal length, 1 / power, infinite for an afocal system
+        """
+        power = self.power()
+        return 1 / power if power != 0 else np.inf
+
+    def focal_lengths(self):
+        """
+        Object-side and image-side focal lengths
+        """
+        return - self.__n * self.efl(), self.__nprime * self.efl()
+
+    def focal_points(self):
+        """
+        Positions of the front and back focal points
+        """
+        (A, B), (C, D) = self.__matrix
+        if C == 0:
+            return np.nan, np.nan
+        return self.__first + self.__n * D / C, self.__last - self.__nprime * A / C
+
+    def bfd(self):
+        """
+        Back focal distance, from the last surface to the back focal point
+        """
+        return self.focal_points()[1] - self.__last
+
+    def ffd(self):
+        """
+        Front focal distance, from the front focal point to the first surface
+        """
+        return self.__first - self.focal_points()[0]
+
+    def principal_planes(self):
+        """
+        Positions of the front and back principal planes
+        """
+        front, back = self.focal_points()
+        f, fprime = self.focal_lengths()
+        return front - f, back - fprime
+
+    def image(self, z=None):
+        """
+        Position and lateral magnification of the paraxial image of an axial object at z, the back focal point for an object at infinity
+        """
+        if z is None or np.isinf(z):
+            return self.focal_points()[1], float(0)
+        (A, B), (C, D) = self.__matrix @ transfer(self.__first - z, self.__n)
+        if D == 0:
+            return np.inf, np.inf
+        return self.__last - self.__nprime * B / D, 1 / D #det = 1
+
+    def properties(self):
+        """
+        All paraxial properties as a dictionary
+        """
+        front, back = self.focal_points()
+        frontplane, backplane = self.principal_planes()
+        f, fprime = self.focal_lengths()
+        return {"wavelength": self.__wavelength, "power": self.power(), "efl": self.efl(), "f": f, "fprime": fprime,
+                "bfd": self.bfd(), "ffd": self.ffd(), "frontfocus": front, "backfocus": back,
+                "frontprincipal": frontplane, "backprincipal": backplane}
+
+    def __repr__(self):
+        return "%s(efl=%g, bfd=%g, wavelength=%g)" % ("ParaxialSystem", self.efl(), self.bfd(), self.__wavelength)
+
+def focus(elements, wavelength=materials.D_LINE):
+    """
+    Paraxial back focal point of a system, NaN when the system is afocal or not rotationally symmetric about the z axis
+    """
+    try:
+        return ParaxialSystem(elements, wavelength).focal_points()[1]
+    except ValueError:
+        return np.nan
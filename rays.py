@@ -10,38 +10,84 @@ Provide sources of light rays, including Ray() and UniformCollimatedBeam().
 
 import numpy as np
 import utils as ut
+import materials
 import simulation
+import analysis
+
+ALIVE = 0
+MISSED = 1 #no intercept with the element
+CLIPPED = 2 #outside the aperture or the dimensions of the element
+TIR = 3 #total internal reflection
+BOUNCES = 4 #still hitting elements after the maximum number of bounces of non-sequential tracing
+REASONS = {ALIVE: "alive", MISSED: "missed", CLIPPED: "clipped", TIR: "tir", BOUNCES: "bounces"}
+PRECISIONS = ("float32", "float64")
+
+def precision(dtype):
+    """
+    The numpy dtype of a precision mode, float32 or float64
+    """
+    dtype = np.dtype(dtype)
+    if dtype.name not in PRECISIONS:
+        raise ValueError("Precision must be one of %s." % (PRECISIONS,))
+    return dtype
 
 class Ray:
     """
-    Objects represent optical rays, they consist of a position, direction and frequency.
+    Objects represent optical rays, they consist of a position, direction, frequency and wavelength (in micrometres).
     The vertices attribute records the positions of the ray at the input plane and its subsequent incidence with other optical elements.
+    A Ray() is a lightweight view into a RayBundle(), a bundle holding a single ray is created when none is given.
     """
     
-    def __init__(self, p=np.zeros(3), k=ut.vec([0,0,1]), freq=float(1)):
-        self.__vertices = [ut.vec(p)]
-        self.__p = ut.vec(p)
-        self.__k = ut.vec(k)
-        self.__freq = float(freq)
-        self.terminated = False   
+    __slots__ = ("__bundle", "__index")
+    
+    def __init__(self, p=np.zeros(3), k=ut.vec([0,0,1]), freq=float(1), wavelength=materials.D_LINE, bundle=None, index=0):
+        if bundle is None:
+            bundle = RayBundle([p], k, freq, wavelength=wavelength)
+        self.__bundle = bundle
+        self.__index = int(index)
+        
+    def bundle(self):
+        return self.__bundle
+    
+    def index(self):
+        return self.__index
+    
+    @property
+    def terminated(self):
+        return bool(self.__bundle.status()[self.__index] != ALIVE)
+    
+    def status(self):
+        """
+        ALIVE, or the reason the ray was terminated
+        """
+        return int(self.__bundle.status()[self.__index])
+    
+    def terminate(self, reason):
+        """
+        Stop the ray, it is not propagated through any further element
+        """
+        self.__bundle.status()[self.__index] = reason
         
     def vertices(self):
-        return self.__vertices
+        return self.__bundle.vertices()[self.__index, :self.__bundle.count()[self.__index]]
         
     def p(self):
-        return self.__vertices[-1]
+        return self.__bundle.vertices()[self.__index, self.__bundle.count()[self.__index] - 1]
     
     def k(self):
-        return self.__k
+        return self.__bundle.k()[self.__index]
     
     def freq(self):
-        return self.__freq
+        return self.__bundle.freq()[self.__index]
+    
+    def wavelength(self):
+        return self.__bundle.wavelength()[self.__index]
     
     def khat(self):
         """
         Provide the unit vector for the direction
         """
-        return ut.hat(self.__k)
+        return ut.hat(self.k())
     
     def append(self, newp):
         """
@@ -49,33 +95,245 @@ class Ray:
         """
         if len(newp) != 3 or not isinstance(newp, np.ndarray):
             raise TypeError
-        self.__vertices.append(ut.vec(newp))
+        self.__bundle.append(ut.vec([newp]), [self.__index])
         
     def ksetter(self, newk):
         """
         Set a new direction
         """
-y        if len(newk) != 3 or not isinstance(newk, np.ndarray):
+        if len(newk) != 3 or not isinstance(newk, np.ndarray):
            raise TypeError
-        self.__k = ut.vec(newk)
+        self.__bundle.ksetter(ut.vec([newk]), [self.__index])
     
     def __repr__(self):
-        return "%s(p=%s, k=%s, vertices=%s, freq=%g)" % ("Ray", self.__vertices[-1], self.__k, self.__vertices, self.__freq)
+        return "%s(p=%s, k=%s, vertices=%s, freq=%g)" % ("Ray", self.p(), self.k(), self.vertices().tolist(), self.freq())
+    
+class RayBundle:
+    """
+    A bundle of light rays stored in contiguous arrays.
+    The vertices of all rays live in one (N, maxvertices, 3) buffer together with the number of vertices recorded for each ray.
+    The buffer grows when a ray runs out of room, reserve() avoids the copies when the number of elements is known.
+    The vertices and directions are stored in the precision given by dtype, float64 or float32, which halves their memory
+    and is carried through the batch kernels, see analysis.precision_check(). Frequencies and wavelengths stay in float64.
+    """
+    
+    def __init__(self, p, k=ut.vec([0,0,1]), freq=float(1), maxvertices=2, wavelength=materials.D_LINE, dtype=float):
+        p = np.array(p, dtype=float, ndmin=2)
+        if p.ndim != 2 or p.shape[1] != 3:
+            raise ValueError("Positions must have shape (N, 3).")
+        N = len(p)
+        self.__vertices = np.empty((N, max(int(maxvertices), 1), 3), dtype=precision(dtype))
+        self.__vertices[:, 0] = p
+        self.__count = np.ones(N, dtype=int)
+        self.__k = np.array(np.broadcast_to(k, (N, 3)), dtype=self.__vertices.dtype)
+        self.__freq = np.array(np.broadcast_to(freq, (N,)), dtype=float)
+        self.__wavelength = np.array(np.broadcast_to(wavelength, (N,)), dtype=float)
+        self.__status = np.zeros(N, dtype=np.int8)
+        
+    @classmethod
+    def frombuffers(cls, vertices, count, k, freq, wavelength, status):
+        """
+        Create a bundle on top of existing arrays without copying them, e.g. slices of shared memory.
+        """
+        bundle = cls.__new__(cls)
+        bundle.__vertices = vertices
+        bundle.__count = count
+        bundle.__k = k
+        bundle.__freq = freq
+        bundle.__wavelength = wavelength
+        bundle.__status = status
+        return bundle
+        
+    def __len__(self):
+        return len(self.__count)
+    
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("Ray index out of range.")
+        return Ray(bundle=self, index=index % len(self))
+    
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Ray(bundle=self, index=index)
+    
+    def vertices(self):
+        """
+        The full (N, maxvertices, 3) buffer, only the first count() vertices of each ray are valid.
+        """
+        return self.__vertices
+    
+    def count(self):
+        return self.__count
+    
+    def dtype(self):
+        """
+        Precision of the vertices and directions
+        """
+        return self.__vertices.dtype
+    
+    def history(self, index):
+        """
+        The (M, 3) vertices of one ray.
+        """
+        return self.__vertices[index, :self.__count[index]]
+    
+    def p(self, index=None):
+        """
+        Current positions of all rays, or of the rays given by index, as an (N, 3) array.
+        """
+        if index is None:
+            index = np.arange(len(self))
+        return self.__vertices[index, self.__count[index] - 1]
+    
+    def k(self):
+        return self.__k
+    
+    def khat(self):
+        return ut.hats(self.__k)
+    
+    def freq(self):
+        return self.__freq
+    
+    def wavelength(self):
+        """
+        Wavelength of every ray in micrometres
+        """
+        return self.__wavelength
+    
+    def status(self):
+        """
+        ALIVE, or the reason each ray was terminated
+        """
+        return self.__status
+    
+    def alive(self):
+        return self.__status == ALIVE
+    
+    def terminated(self):
+        return self.__status != ALIVE
+    
+    def objectlist(self):
+        """
+        Ray() views of every ray in the bundle.
+        """
+        return list(self)
+    
+    def chunks(self, chunk_size):
+        """
+        Yield consecutive bundles of at most chunk_size rays which share the arrays of this bundle.
+        """
+        for start in range(0, len(self), int(chunk_size)):
+            stop = start + int(chunk_size)
+            yield RayBundle.frombuffers(self.__vertices[start:stop], self.__count[start:stop], self.__k[start:stop], self.__freq[start:stop], self.__wavelength[start:stop], self.__status[start:stop])
+    
+    def reserve(self, maxvertices):
+        """
+        Make room for at least maxvertices vertices per ray.
+        """
+        if maxvertices > self.__vertices.shape[1]:
+            vertices = np.empty((len(self), int(maxvertices), 3), dtype=self.__vertices.dtype)
+            vertices[:, :self.__vertices.shape[1]] = self.__vertices
+            self.__vertices = vertices
+    
+    def append(self, newp, index=None):
+        """
+        Add new positions to the rays given by index, or to all rays.
+        """
+        if index is None:
+            index = np.arange(len(self))
+        index = np.asarray(index, dtype=int)
+        if len(index) == 0:
+            return
+        count = self.__count[index]
+        if count.max() >= self.__vertices.shape[1]:
+            self.reserve(2 * self.__vertices.shape[1])
+        self.__vertices[index, count] = newp
+        self.__count[index] = count + 1
+        
+    def ksetter(self, newk, index=None):
+        """
+        Set new directions for the rays given by index, or for all rays.
+        """
+        if index is None:
+            self.__k[:] = newk
+        else:
+            self.__k[np.asarray(index, dtype=int)] = newk
+    
+    def __repr__(self):
+        return "%s(N=%d, maxvertices=%d, dtype=%s)" % ("RayBundle", len(self), self.__vertices.shape[1], self.__vertices.dtype)
+    
+def polychromatic(bundle, wavelengths):
+    """
+    Repeat the rays of a bundle once for every wavelength, giving a new bundle ordered wavelength by wavelength.
+    """
+    wavelengths = np.ravel(wavelengths)
+    N = len(bundle)
+    return RayBundle(np.tile(bundle.p(), (len(wavelengths), 1)), np.tile(bundle.k(), (len(wavelengths), 1)), np.tile(bundle.freq(), len(wavelengths)),
+                     wavelength=np.repeat(wavelengths, N), dtype=bundle.dtype())
+    
+def collect(source, chunk_size=65536):
+    """
+    All rays of a source, or of a list of sources, in one new untraced RayBundle().
+    A source is a RayBundle() or an object with a chunks(chunk_size) method, the precision of the sources is kept.
+    """
+    sources = source if isinstance(source, (list, tuple)) else [source]
+    chunks = [chunk for src in sources for chunk in src.chunks(chunk_size)]
+    if not chunks:
+        return RayBundle(np.empty((0, 3)))
+    return RayBundle(np.concatenate([chunk.p() for chunk in chunks]), np.concatenate([chunk.k() for chunk in chunks]),
+                     np.concatenate([chunk.freq() for chunk in chunks]), wavelength=np.concatenate([chunk.wavelength() for chunk in chunks]),
+                     dtype=np.result_type(*(chunk.dtype() for chunk in chunks)))
+    
+class PolychromaticSource:
+    """
+    A source of rays repeated for every wavelength, chunk by chunk, see polychromatic().
+    """
+    
+    def __init__(self, source, wavelengths):
+        self.__source = source
+        self.__wavelengths = np.ravel(wavelengths).astype(float)
+        
+    def wavelengths(self):
+        return self.__wavelengths
+    
+    def source(self):
+        return self.__source
+    
+    def __len__(self):
+        return len(self.__source) * len(self.__wavelengths)
+    
+    def chunks(self, chunk_size):
+        """
+        Yield bundles of at most chunk_size rays, every chunk of the source is repeated for all wavelengths.
+        """
+        for chunk in self.__source.chunks(max(int(chunk_size) // len(self.__wavelengths), 1)):
+            yield polychromatic(chunk, self.__wavelengths)
+    
+    def __repr__(self):
+        return "%s(source=%s, wavelengths=%s)" % ("PolychromaticSource", self.__source, self.__wavelengths.tolist())
     
 class UniformCollimatedBeam:
     """
     Create light rays in rings from a circular surface.
     The rays are arranged to have a near uniform density distribution across the surface.
+    The bundles are created in the precision given by dtype, see RayBundle().
     """
 
-    def __init__(self, centre=np.zeros(3), k=ut.vec([0,0,1]), radius=2.5, density=0.625): 
+    def __init__(self, centre=np.zeros(3), k=ut.vec([0,0,1]), radius=2.5, density=0.625, dtype=float): 
         self.__points = []
-        self.__objectlist = []
+        self.__bundle = RayBundle(np.empty((0, 3)))
         self.__centre = ut.vec(centre)
         self.__k = ut.vec(k)
         self.__radius = float(radius)
         self.__density = float(density)
+        self.__dtype = precision(dtype)
         
+    def params(self):
+        """
+        Parameters which recreate the beam as keyword arguments.
+        """
+        return {"centre": self.__centre, "k": self.__k, "radius": self.__radius, "density": self.__density, "dtype": self.__dtype.name}
+    
     def points(self):
         """
         Points given in vector form.
@@ -86,45 +344,233 @@ class UniformCollimatedBeam:
         """
         Stored as Ray() objects, used in simulation.
         """
-        return self.__objectlist
+        return self.__bundle.objectlist()
+    
+    def bundle(self):
+        """
+        Stored as a RayBundle(), used in simulation.
+        """
+        return self.__bundle
+
+    def axis(self):
+        """
+        Radii of the rings, the first ring being the centre point.
+        """
+        return np.arange(0, self.__radius + self.__density, self.__density)
+    
+    def __len__(self):
+        axis = self.axis()
+        return len(axis) + int(sum(3 * 2 ** i - 1 for i in range(1, len(axis))))
+    
+    def positions(self, start=0, stop=None):
+        """
+        Positions of the rays start:stop in closed form, in the order used by generate().
+        The points along the axis come first, then the remaining points of each ring.
+        """
+        axis = self.axis()
+        M = len(axis)
+        stop = len(self) if stop is None else min(stop, len(self))
+        index = np.arange(start, stop)
+        rings = np.arange(1, M)
+        ringstarts = M + 3 * (2 ** rings - 2) - (rings - 1) #index of the first off-axis point of each ring
+        onaxis = index < M
+        ring = np.where(onaxis, index, rings[np.maximum(np.searchsorted(ringstarts, index, side='right') - 1, 0)] if M > 1 else 0)
+        N = 3 * 2.0 ** ring
+        step = np.where(onaxis, 0, index - ringstarts[np.maximum(ring - 1, 0)] + 1) if M > 1 else np.zeros(len(index))
+        angle = 2 * np.pi / N
+        r = axis[ring]
+        points = np.zeros((len(index), 3))
+        points[:, 0] = np.where(onaxis, r, r * np.cos(angle * step))
+        points[:, 1] = np.where(onaxis, 0, r * np.sin(angle * step))
+        return points + self.__centre
 
     def generate(self):
         """
         Points are created along an axis in a fixed interval.
         Rings of points are then created by rotating the points on the axis, starting from the inner most circle.
+        All points are computed at once in closed form.
+        """
+        self.__points = self.positions()
+        self.__bundle = RayBundle(self.__points, self.__k, dtype=self.__dtype) #Storing every point as a ray in one bundle
+        
+    def chunks(self, chunk_size):
+        """
+        Yield the rays as RayBundle() objects of at most chunk_size rays without generating the whole beam.
         """
-        axis = np.arange(0, self.__radius + self.__density, self.__density).tolist()
-        for point in axis:
-            axialpoint = ut.vec([point,0,0]) + self.__centre
-            self.__points.append(axialpoint)
-        for point in axis[1:]:
-            N = 3 * (2 ** (axis.index(point)))
-            angle = 2 * np.pi / N
-            r = point
-            for k in range(N-1):
-                x = r * np.cos(angle * (k+1))
-                y = r * np.sin(angle * (k+1))
-                newpoint = ut.vec([x,y,0]) + self.__centre
-                self.__points.append(newpoint)
-        for point in self.__points: #Turning every item in the list to a Ray()
-            self.__objectlist.append(Ray(point, self.__k))
+        for start in range(0, len(self), int(chunk_size)):
+            yield RayBundle(self.positions(start, start + int(chunk_size)), self.__k, dtype=self.__dtype)
     
     def rms(self, sim):
         """
-        Calculate the RMS spot radius.
+        Calculate the RMS spot radius about the first ray, the centre of the beam.
         """
-        total = 0
-        for ray in sim.rays():
-            squareddiff = ut.norm(ut.vec([ray.p()[0] - sim.rays()[0].p()[0], ray.p()[1] - sim.rays()[0].p()[1], 0])) * ut.norm(ut.vec([ray.p()[0] - sim.rays()[0].p()[0], ray.p()[1] - sim.rays()[0].p()[1], 0]))
-            total = total + squareddiff
-        rms = np.sqrt(total / (len(sim.rays()))) 
-        return rms
-   
-   
+        return analysis.rms(sim, centre=sim.rays()[0].p())
 
+def basis(k):
+    """
+    Two unit vectors perpendicular to k and to each other, x and y for a k along z
+    """
+    khat = ut.hat(ut.vec(k))
+    a = ut.vec([1,0,0]) if abs(khat[1]) > 0.9 else ut.vec([0,1,0])
+    u = ut.hat(np.cross(a, khat))
+    return u, np.cross(khat, u)
 
-            
-            
+class RandomSource:
+    """
+    Base class of the stochastic sources of N rays.
+    The rays are drawn in blocks of a fixed size, each block from its own numpy Generator spawned from the seed,
+    so any range of rays is the same whatever the chunks it is generated in, e.g. by a streaming or a parallel run.
+    Subclasses draw the positions and directions of a block in sample(rng, n).
+    """
+    
+    def __init__(self, N=10000, seed=0, wavelength=materials.D_LINE, block=4096, dtype=float):
+        self.__N = int(N)
+        self.__seed = int(seed)
+        self.__wavelength = float(wavelength)
+        self.__block = int(block)
+        self.__dtype = precision(dtype)
+        
+    def __len__(self):
+        return self.__N
+    
+    def seed(self):
+        return self.__seed
+    
+    def params(self):
+        """
+        Parameters which recreate the source as keyword arguments.
+        """
+        return {"N": self.__N, "seed": self.__seed, "wavelength": self.__wavelength, "block": self.__block, "dtype": self.__dtype.name}
+    
+    def generator(self, block):
+        """
+        The Generator of one block of rays
+        """
+        return np.random.default_rng(np.random.SeedSequence(self.__seed, spawn_key=(int(block),)))
+    
+    def sample(self, rng, n):
+        raise NotImplementedError()
+    
+    def rays(self, start=0, stop=None):
+        """
+        Positions and directions of the rays start:stop as (M, 3) arrays, only the blocks holding them are drawn.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        if stop <= start:
+            return np.empty((0, 3)), np.empty((0, 3))
+        first, last = start // self.__block, (stop - 1) // self.__block + 1
+        p, k = zip(*(self.sample(self.generator(b), min(self.__block, self.__N - b * self.__block)) for b in range(first, last)))
+        offset = first * self.__block
+        return np.concatenate(p)[start - offset:stop - offset], np.concatenate(k)[start - offset:stop - offset]
+    
+    def bundle(self, start=0, stop=None):
+        """
+        The rays start:stop as a RayBundle()
+        """
+        p, k = self.rays(start, stop)
+        return RayBundle(p, k, wavelength=self.__wavelength, dtype=self.__dtype)
+    
+    def chunks(self, chunk_size):
+        """
+        Yield the rays as RayBundle() objects of at most chunk_size rays.
+        """
+        for start in range(0, len(self), int(chunk_size)):
+            yield self.bundle(start, start + int(chunk_size))
+    
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%s" % (name, value) for name, value in self.params().items()))
+    
+class RandomDiskBeam(RandomSource):
+    """
+    Collimated rays along k starting uniformly at random on a disc of the given radius perpendicular to k.
+    """
+    
+    def __init__(self, centre=np.zeros(3), k=ut.vec([0,0,1]), radius=2.5, **kwargs):
+        super().__init__(**kwargs)
+        self.__centre = ut.vec(centre)
+        self.__k = ut.vec(k)
+        self.__radius = float(radius)
+        
+    def params(self):
+        return {"centre": self.__centre, "k": self.__k, "radius": self.__radius, **super().params()}
+    
+    def sample(self, rng, n):
+        r = self.__radius * np.sqrt(rng.random(n))
+        phi = 2 * np.pi * rng.random(n)
+        u, v = basis(self.__k)
+        p = self.__centre + (r * np.cos(phi))[:, np.newaxis] * u + (r * np.sin(phi))[:, np.newaxis] * v
+        return p, np.broadcast_to(self.__k, (n, 3))
+    
+class GaussianBeam(RandomSource):
+    """
+    Collimated rays along k whose starting points follow a Gaussian beam profile of 1/e^2 intensity radius waist,
+    cut off at radius when one is given.
+    """
+    
+    def __init__(self, centre=np.zeros(3), k=ut.vec([0,0,1]), waist=1.0, radius=None, **kwargs):
+        super().__init__(**kwargs)
+        self.__centre = ut.vec(centre)
+        self.__k = ut.vec(k)
+        self.__waist = float(waist)
+        self.__radius = None if radius is None else float(radius)
         
+    def params(self):
+        return {"centre": self.__centre, "k": self.__k, "waist": self.__waist, "radius": self.__radius, **super().params()}
+    
+    def sample(self, rng, n):
+        #inverse of the fraction of the power within r, 1 - exp(-2 r^2 / waist^2), scaled to the cut-off
+        cut = 1 if self.__radius is None else - np.expm1(-2 * self.__radius ** 2 / self.__waist ** 2)
+        r = self.__waist * np.sqrt(- np.log1p(- cut * rng.random(n)) / 2)
+        phi = 2 * np.pi * rng.random(n)
+        u, v = basis(self.__k)
+        p = self.__centre + (r * np.cos(phi))[:, np.newaxis] * u + (r * np.sin(phi))[:, np.newaxis] * v
+        return p, np.broadcast_to(self.__k, (n, 3))
     
+class PointSource(RandomSource):
+    """
+    Rays from a point emitted uniformly in solid angle into a cone about k of the given half-angle in degrees.
+    """
+    
+    def __init__(self, centre=np.zeros(3), k=ut.vec([0,0,1]), halfangle=10.0, **kwargs):
+        super().__init__(**kwargs)
+        self.__centre = ut.vec(centre)
+        self.__k = ut.vec(k)
+        self.__halfangle = float(halfangle)
+        
+    def params(self):
+        return {"centre": self.__centre, "k": self.__k, "halfangle": self.__halfangle, **super().params()}
+    
+    def sample(self, rng, n):
+        costheta = 1 - rng.random(n) * (1 - np.cos(np.radians(self.__halfangle)))
+        sintheta = np.sqrt(1 - costheta * costheta)
+        phi = 2 * np.pi * rng.random(n)
+        u, v = basis(self.__k)
+        k = (sintheta * np.cos(phi))[:, np.newaxis] * u + (sintheta * np.sin(phi))[:, np.newaxis] * v + costheta[:, np.newaxis] * ut.hat(self.__k)
+        return np.broadcast_to(self.__centre, (n, 3)), k
+    
+class FieldBeam(RandomSource):
+    """
+    Collimated rays of an off-axis field point, tilted from the z axis by angle degrees towards the azimuth in degrees
+    (90 tilts towards y), starting uniformly at random on a disc of the given radius in the plane z = centre[2],
+    e.g. filling the entrance pupil.
+    """
+    
+    def __init__(self, centre=np.zeros(3), angle=5.0, azimuth=90.0, radius=2.5, **kwargs):
+        super().__init__(**kwargs)
+        self.__centre = ut.vec(centre)
+        self.__angle = float(angle)
+        self.__azimuth = float(azimuth)
+        self.__radius = float(radius)
+        
+    def params(self):
+        return {"centre": self.__centre, "angle": self.__angle, "azimuth": self.__azimuth, "radius": self.__radius, **super().params()}
+    
+    def k(self):
+        theta, phi = np.radians(self.__angle), np.radians(self.__azimuth)
+        return ut.vec([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)])
     
+    def sample(self, rng, n):
+        r = self.__radius * np.sqrt(rng.random(n))
+        phi = 2 * np.pi * rng.random(n)
+        p = self.__centre + np.column_stack([r * np.cos(phi), r * np.sin(phi), np.zeros(n)])
+        return p, np.broadcast_to(self.k(), (n, 3))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Describe optical systems, their light sources and the analyses to run in JSON or TOML scene files,
+and run scenes from the command line without a display, e.g.
+
+    python scene.py scenes/task15.json scenes/chromatic.toml --output results
+
+Every element is given by its type and the keyword arguments of its class, refractive indices may be numbers,
+the name of a medium in materials (e.g. "BK7") or a table such as {"type": "Sellmeier", "B": [...], "C": [...]}.
+matplotlib is only imported when a scene asks for a render.
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rays
+import materials
+import simulation
+import analysis
+import opticalelements
+import telemetry
+import tracefile
+
+try:
+    import tomllib
+except ImportError: #Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+ELEMENTS = {"SphericalRefraction": opticalelements.SphericalRefraction, "Plane": opticalelements.Plane,
+            "OutputPlane": opticalelements.OutputPlane, "SphericalMirror": opticalelements.SphericalMirror,
+            "PlaneMirror": opticalelements.PlaneMirror}
+SOURCES = {"UniformCollimatedBeam": rays.UniformCollimatedBeam, "RandomDiskBeam": rays.RandomDiskBeam, "GaussianBeam": rays.GaussianBeam,
+           "PointSource": rays.PointSource, "FieldBeam": rays.FieldBeam}
+MEDIA = {"Constant": materials.Constant, "Sellmeier": materials.Sellmeier, "Cauchy": materials.Cauchy}
+
+def load(path):
+    """
+    Read a scene file, JSON or TOML by its extension. The name of the scene defaults to the file name.
+    """
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ImportError("Reading TOML scenes needs Python 3.11 or the tomli package.")
+        with open(path, "rb") as f:
+            spec = tomllib.load(f)
+    else:
+        with open(path) as f:
+            spec = json.load(f)
+    spec.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    return spec
+
+def medium(spec):
+    """
+    A refractive index or medium from a scene
+    """
+    if isinstance(spec, str):
+        return getattr(materials, spec)
+    if isinstance(spec, dict):
+        params = dict(spec)
+        return MEDIA[params.pop("type")](**params)
+    return float(spec)
+
+def element(spec):
+    """
+    An optical element from a scene, the parameters may also be nested under 'params' as in tracefile.describe()
+    """
+    params = {name: value for name, value in spec.items() if name not in ("type", "params")}
+    params.update(spec.get("params", {}))
+    for name in ("n1", "n2"):
+        if name in params:
+            params[name] = medium(params[name])
+    if spec["type"] not in ELEMENTS:
+        raise ValueError("Unknown element %s." % spec["type"])
+    return ELEMENTS[spec["type"]](**params)
+
+def source(spec):
+    """
+    A source of rays from a scene, anything with a chunks(chunk_size) method.
+    A list of wavelengths repeats the source for every wavelength.
+    """
+    params = {name: value for name, value in spec.items() if name not in ("type", "wavelengths")}
+    if spec["type"] == "Rays":
+        result = rays.RayBundle(params.pop("p"), **params)
+    elif spec["type"] in SOURCES:
+        result = SOURCES[spec["type"]](**params)
+    else:
+        raise ValueError("Unknown source %s." % spec["type"])
+    if "wavelengths" in spec:
+        result = rays.PolychromaticSource(result, spec["wavelengths"])
+    return result
+
+def build(spec):
+    """
+    The Simulation() and the sources of a scene
+    """
+    renders = any(item["type"].startswith("render") for item in spec.get("analyses", []))
+    sim = simulation.Simulation(retain=renders, **spec.get("simulation", {}))
+    sim.appendelements(*(element(elem) for elem in spec.get("elements", [])))
+    return sim, [source(src) for src in spec.get("sources", [])]
+
+def plain(value):
+    """
+    A result as plain JSON values
+    """
+    if isinstance(value, dict):
+        return {str(key): plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [plain(item) for item in value]
+    if isinstance(value, (float, np.floating)) and not np.isfinite(value):
+        return None
+    return tracefile.jsonable(value)
+
+def render(sim, spec, outdir):
+    """
+    Render the retained rays to a file, importing the plotting module only now
+    """
+    import graphics
+    filename = os.path.join(outdir, spec.get("filename", spec["type"] + ".png"))
+    x1, x2, y1, y2 = spec.get("limits", [-5, 5, -5, 5])
+    if spec["type"] == "render3d":
+        graphics.render3d(sim, spec.get("title", ""), x1, x2, y1, y2, maxrays=spec.get("maxrays", 2000), filename=filename)
+    else:
+        graphics.render2d(sim, spec.get("title", ""), x1, x2, y1, y2, mode=spec.get("mode", "scatter"), bins=spec.get("bins", 512), filename=filename)
+    return filename
+
+def run(spec, outdir=".", chunk_size=65536):
+    """
+    Trace the sources of a scene chunk by chunk and run its analyses.
+    Spot statistics, traces and telemetry are gathered while the chunks stream past, the focus analyses retrace the sources.
+    Return the results as plain JSON values.
+    """
+    sim, sources = build(spec)
+    analyses = spec.get("analyses", [])
+    spots, writers, results = {}, {}, {}
+    for item in analyses:
+        key = item.get("name", item["type"])
+        if item["type"] == "spot":
+            spots[key] = (analysis.SpotStatistics(item.get("centre", np.zeros(2))), item.get("fractions", [0.5, 0.8, 0.9]))
+        elif item["type"] == "trace":
+            writers[key] = tracefile.TraceWriter(os.path.join(outdir, item.get("path", spec["name"] + ".trace")), sim.elements(), item.get("compression"))
+        elif item["type"] == "telemetry":
+            results[key] = telemetry.Telemetry()
+            sim.addhook(results[key])
+    N, alive = 0, 0
+    for src in sources:
+        for chunk in sim.propagate_iter(src, chunk_size):
+            N, alive = N + len(chunk), alive + int(chunk.alive().sum())
+            for statistics, fractions in spots.values():
+                statistics.update(chunk)
+            for writer in writers.values():
+                writer.write(chunk)
+    for key, (statistics, fractions) in spots.items():
+        results[key] = statistics.statistics(fractions)
+    for key, writer in writers.items():
+        writer.close()
+        results[key] = {"path": writer.path(), "rays": len(writer)}
+    for item in analyses:
+        key = item.get("name", item["type"])
+        if item["type"] == "telemetry":
+            if "prometheus" in item:
+                results[key].write_prometheus(os.path.join(outdir, item["prometheus"]))
+            results[key] = results[key].asdict()
+        elif item["type"] == "best_focus":
+            focus = analysis.find_best_focus(sim, rays.collect(sources, chunk_size), chunk_size=chunk_size)
+            results[key] = {name: focus[name] for name in ("bestfocus", "rms", "paraxialfocus")}
+        elif item["type"] == "chromatic":
+            results[key] = analysis.chromatic(sim, rays.collect(sources, chunk_size), chunk_size=chunk_size)
+        elif item["type"].startswith("render"):
+            results[key] = {"filename": render(sim, item, outdir)}
+        elif key not in results:
+            raise ValueError("Unknown analysis %s." % item["type"])
+    return plain({"name": spec["name"], "rays": N, "alive": alive, "results": results})
+
+def runfile(path, outdir=".", chunk_size=65536):
+    """
+    Run a scene file and write its results to outdir as <name>.json
+    """
+    spec = load(path)
+    os.makedirs(outdir, exist_ok=True)
+    result = run(spec, outdir, chunk_size)
+    with open(os.path.join(outdir, spec["name"] + ".json"), "w") as f:
+        json.dump(result, f, indent=1)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ray tracing scenes without a display.")
+    parser.add_argument("scenes", nargs="+", help="JSON or TOML scene files")
+    parser.add_argument("--output", default=".", help="directory for the results")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="rays traced at once")
+    parser.add_argument("--jobs", type=int, default=1, help="scenes run in parallel")
+    args = parser.parse_args(argv)
+    os.environ.setdefault("MPLBACKEND", "Agg") #never open a window
+    if args.jobs > 1:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            results = list(pool.map(runfile, args.scenes, [args.output] * len(args.scenes), [args.chunk_size] * len(args.scenes)))
+    else:
+        results = [runfile(path, args.output, args.chunk_size) for path in args.scenes]
+    for result in results:
+        print("%s: %d rays, %d alive" % (result["name"], result["rays"], result["alive"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
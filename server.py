@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A long-lived local trace service, so tools tracing small bundles many times per second pay for Python and the compiled
+systems only once, e.g.
+
+    python server.py --socket /tmp/raytracer.sock scenes/task15.json
+
+Scenes are loaded once and kept compiled. Trace requests arriving together for the same scene are coalesced into one
+RayBundle(), traced with one batch call per element and split back to the callers.
+Messages are frames of a JSON header followed by the raw bytes of the arrays it lists, TraceClient() speaks the protocol.
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import io
+import json
+import socket
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rays
+import materials
+import scene
+import tracefile
+
+HEADER = struct.Struct("!Q") #length of the JSON header
+
+def encode(header, arrays={}):
+    """
+    A frame holding a JSON header and the raw bytes of the arrays, listed in the header by name, dtype and shape
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    header = dict(header, arrays=[[name, array.dtype.str, list(array.shape)] for name, array in arrays.items()])
+    text = json.dumps(header).encode()
+    return b"".join([HEADER.pack(len(text)), text] + [array.tobytes() for array in arrays.values()])
+
+def decode(text, read):
+    """
+    The header and arrays of a frame given its JSON header and a function reading a number of bytes
+    """
+    header = json.loads(text)
+    arrays = {}
+    for name, dtype, shape in header.pop("arrays", []):
+        dtype = np.dtype(dtype)
+        arrays[name] = np.frombuffer(read(int(np.prod(shape, dtype=int)) * dtype.itemsize), dtype=dtype).reshape(shape)
+    return header, arrays
+
+async def receive(reader):
+    """
+    Read a frame from an asyncio stream, None when the stream is closed
+    """
+    try:
+        size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+        text = await reader.readexactly(size)
+        sizes = [int(np.prod(shape, dtype=int)) * np.dtype(dtype).itemsize for name, dtype, shape in json.loads(text).get("arrays", [])]
+        return decode(text, io.BytesIO(await reader.readexactly(sum(sizes))).read)
+    except asyncio.IncompleteReadError:
+        return None
+
+def identify(sim):
+    """
+    Stable name of a compiled system: a hash of its elements and tracing mode
+    """
+    description = {"elements": tracefile.describe(sim.elements()), "sequential": sim.sequential(), "maxbounces": sim.maxbounces()}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+
+class TraceServer:
+    """
+    Serve trace requests over a Unix socket or TCP on localhost.
+    Requests for the same scene and precision arriving within window seconds of each other are traced as one batch
+    of at most maxbatch rays, in a pool of workers threads so the event loop keeps accepting requests meanwhile.
+    The operations are load (a scene, see scene.py, or the path of a scene file), trace, scenes and stats.
+    """
+
+    def __init__(self, window=0.002, maxbatch=262144, workers=1):
+        self.__window = float(window)
+        self.__maxbatch = int(maxbatch)
+        self.__executor = ThreadPoolExecutor(max(int(workers), 1))
+        self.__scenes = {}
+        self.__pending = {}
+        self.__server = None
+        self.__started = time.perf_counter()
+        self.__latencies = collections.deque(maxlen=10000)
+        self.__counters = {"requests": 0, "rays": 0, "batches": 0, "errors": 0, "trace_seconds": float(0)}
+
+    def scenes(self):
+        return self.__scenes
+
+    def load(self, spec):
+        """
+        Build and compile the system of a scene, keep it and return its name. Loading the same system again reuses it.
+        """
+        if isinstance(spec, str):
+            spec = scene.load(spec)
+        sim, sources = scene.build(dict(spec, analyses=[]))
+        name = identify(sim)
+        if name not in self.__scenes:
+            sim.compile()
+            self.__scenes[name] = sim
+        return name
+
+    def stats(self):
+        """
+        Latency percentiles of the trace requests in milliseconds, over the last 10000, and the throughput counters
+        """
+        latencies = 1000 * np.array(self.__latencies)
+        percentiles = dict(zip(("p50", "p95", "p99", "max"), np.percentile(latencies, [50, 95, 99, 100]).tolist())) if len(latencies) else {}
+        uptime = time.perf_counter() - self.__started
+        counters = self.__counters
+        return {"uptime": uptime, "scenes": len(self.__scenes), **counters, "latency_ms": percentiles,
+                "requests_per_batch": counters["requests"] / counters["batches"] if counters["batches"] else float(0),
+                "rays_per_second": counters["rays"] / counters["trace_seconds"] if counters["trace_seconds"] > 0 else float(0),
+                "requests_per_second": counters["requests"] / uptime}
+
+    async def trace(self, name, p, k, wavelength=None):
+        """
+        Queue rays to be traced through a loaded scene with the next batch and wait for their final state.
+        """
+        if name not in self.__scenes:
+            raise ValueError("Unknown scene %s." % name)
+        dtype = rays.precision(p.dtype)
+        bundle = rays.RayBundle(p, k, wavelength=materials.D_LINE if wavelength is None else wavelength, dtype=dtype)
+        future = asyncio.get_running_loop().create_future()
+        key = (name, dtype.str)
+        if key not in self.__pending: #the first request of a batch starts its window
+            self.__pending[key] = ([], asyncio.get_running_loop().call_later(self.__window, self.__flush, key))
+        batch, timer = self.__pending[key]
+        batch.append((bundle, future))
+        if sum(len(item) for item, future in batch) >= self.__maxbatch:
+            self.__flush(key)
+        return await future
+
+    def __flush(self, key):
+        """
+        Start tracing the requests waiting for a scene as one bundle, a batch flushed early as it is full stops its timer
+        so the next batch gets a whole window
+        """
+        batch, timer = self.__pending.pop(key, ([], None))
+        if timer is not None:
+            timer.cancel()
+        if batch:
+            asyncio.get_running_loop().create_task(self.__run(key[0], batch))
+
+    async def __run(self, name, batch):
+        bundles = [bundle for bundle, future in batch]
+        combined = rays.RayBundle(np.concatenate([bundle.p() for bundle in bundles]), np.concatenate([bundle.k() for bundle in bundles]),
+                                  wavelength=np.concatenate([bundle.wavelength() for bundle in bundles]), dtype=bundles[0].dtype())
+        sim = self.__scenes[name]
+        begin = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.__executor, sim.trace, combined)
+        except Exception as error:
+            for bundle, future in batch:
+                if not future.cancelled():
+                    future.set_exception(error)
+            return
+        self.__counters["trace_seconds"] += time.perf_counter() - begin
+        self.__counters["batches"] += 1
+        start = 0
+        p, k, status = combined.p(), combined.k(), combined.status()
+        for bundle, future in batch:
+            stop = start + len(bundle)
+            if not future.cancelled():
+                future.set_result({"p": p[start:stop], "k": k[start:stop], "status": status[start:stop]})
+            start = stop
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests of one connection in turn until it closes
+        """
+        try:
+            while True:
+                message = await receive(reader)
+                if message is None:
+                    break
+                header, arrays = message
+                begin = time.perf_counter()
+                try:
+                    reply, result = self.__answer(header), {}
+                    if header.get("op") == "trace":
+                        result = await self.trace(header["scene"], arrays["p"], arrays["k"], arrays.get("wavelength"))
+                        self.__latencies.append(time.perf_counter() - begin)
+                        self.__counters["requests"] += 1
+                        self.__counters["rays"] += len(arrays["p"])
+                except Exception as error:
+                    self.__counters["errors"] += 1
+                    reply, result = {"error": "%s: %s" % (type(error).__name__, error)}, {}
+                writer.write(encode(reply, result))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def __answer(self, header):
+        op = header.get("op")
+        if op == "load":
+            return {"scene": self.load(header.get("path") or header["spec"])}
+        if op == "scenes":
+            return {"scenes": {name: tracefile.describe(sim.elements()) for name, sim in self.__scenes.items()}}
+        if op == "stats":
+            return {"stats": scene.plain(self.stats())}
+        if op == "trace":
+            return {}
+        raise ValueError("Unknown operation %s." % op)
+
+    async def start(self, path=None, host="127.0.0.1", port=0):
+        """
+        Listen on the Unix socket path, or on host and port (0 picks a free port). Return the address listened on.
+        """
+        if path is not None:
+            self.__server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            self.__server = await asyncio.start_server(self.handle, host, port)
+        return self.__server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self.__server.serve_forever()
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.close()
+        self.__executor.shutdown(wait=False)
+
+    def __repr__(self):
+        return "%s(scenes=%d, window=%g, maxbatch=%d)" % ("TraceServer", len(self.__scenes), self.__window, self.__maxbatch)
+
+class TraceClient:
+    """
+    A blocking client of a TraceServer(), one connection per client. Use one client per thread.
+    """
+
+    def __init__(self, path=None, host="127.0.0.1", port=None):
+        if path is not None:
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.__socket.connect(path)
+        else:
+            self.__socket = socket.create_connection((host, port))
+            self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            block = self.__socket.recv(size - len(data))
+            if not block:
+                raise ConnectionError("The trace server closed the connection.")
+            data += block
+        return bytes(data)
+
+    def request(self, header, arrays={}):
+        """
+        Send a request and wait for the reply, errors of the server are raised as RuntimeError
+        """
+        self.__socket.sendall(encode(header, arrays))
+        size, = HEADER.unpack(self.__read(HEADER.size))
+        reply, arrays = decode(self.__read(size), self.__read)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply, arrays
+
+    def load(self, spec):
+        """
+        Load a scene, given as a dictionary or the path of a scene file readable by the server, and return its name
+        """
+        header = {"op": "load", "path": spec} if isinstance(spec, str) else {"op": "load", "spec": spec}
+        return self.request(header)[0]["scene"]
+
+    def trace(self, name, source, wavelength=None):
+        """
+        Trace a RayBundle(), or (N, 3) positions given with directions as a (p, k) pair, through a loaded scene.
+        Return a RayBundle() holding the final state of the rays.
+        """
+        if isinstance(source, rays.RayBundle):
+            p, k, wavelength = source.p(), source.k(), source.wavelength()
+        else:
+            p, k = source
+            p = np.asarray(p, dtype=getattr(p, "dtype", float)).reshape(-1, 3)
+            k = np.broadcast_to(np.asarray(k, dtype=p.dtype), p.shape)
+        arrays = {"p": p, "k": k}
+        if wavelength is not None:
+            arrays["wavelength"] = np.broadcast_to(np.asarray(wavelength, dtype=float), (len(p),))
+        reply, result = self.request({"op": "trace", "scene": name}, arrays)
+        return rays.RayBundle.frombuffers(result["p"].copy()[:, np.newaxis], np.ones(len(p), dtype=int), result["k"].copy(),
+                                          np.ones(len(p)), np.array(arrays.get("wavelength", np.full(len(p), materials.D_LINE))), result["status"].copy())
+
+    def scenes(self):
+        return self.request({"op": "scenes"})[0]["scenes"]
+
+    def stats(self):
+        return self.request({"op": "stats"})[0]["stats"]
+
+    def close(self):
+        self.__socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "%s(peer=%s)" % ("TraceClient", self.__socket.getpeername())
+
+async def serve(scenes=(), path=None, host="127.0.0.1", port=0, window=0.002, maxbatch=262144, workers=1):
+    server = TraceServer(window, maxbatch, workers)
+    for spec in scenes:
+        print("%s: %s" % (spec, server.load(spec)))
+    print("listening on %s" % (await server.start(path, host, port),), flush=True)
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve ray traces of loaded scenes on a local socket.")
+    parser.add_argument("scenes", nargs="*", help="JSON or TOML scene files to load up front")
+    parser.add_argument("--socket", help="Unix socket path, TCP on localhost when not given")
+    parser.add_argument("--host", default="127.0.0.1", help="TCP host")
+    parser.add_argument("--port", type=int, default=0, help="TCP port, 0 picks a free port")
+    parser.add_argument("--window", type=float, default=0.002, help="seconds requests wait to be coalesced")
+    parser.add_argument("--max-batch", type=int, default=262144, help="rays traced in one batch at most")
+    parser.add_argument("--workers", type=int, default=1, help="threads tracing batches")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.scenes, args.socket, args.host, args.port, args.window, args.max_batch, args.workers))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
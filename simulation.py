@@ -9,46 +9,475 @@ Contain light sources and optical elements.
 Act as a simulator for raytracing.
 """
 
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import utils as ut
 import rays
 import opticalelements
+import bvh
 
 class Simulation:
-    def __init__(self):
+    """
+    Propagate rays through a list of optical elements.
+    The propagated rays are only kept, and returned by rays(), when retain is True.
+    With sequential=False every ray meets whichever element it hits next, in any order, for at most maxbounces elements.
+    Instrumentation hooks, such as telemetry.Telemetry(), are told about every bundle traced and every element it meets,
+    without hooks nothing is timed or counted.
+    With checkpoints=True the state of the rays of the last bundle traced is kept before every element,
+    so retrace() resumes from the first element replaced, inserted or appended since.
+    """
+    
+    def __init__(self, retain=False, sequential=True, maxbounces=64, hooks=(), checkpoints=False):
+        self.__plans = {}
         self.__elements = []
         self.__rays = []
+        self.__bundles = []
+        self.__retain = bool(retain)
+        self.__sequential = bool(sequential)
+        self.__maxbounces = int(maxbounces)
+        self.__hooks = list(hooks)
+        self.__checkpoint = bool(checkpoints)
+        self.__checkpoints = []
+        self.__traced = None
+        self.__changed = None
     
     def elements(self):
         return self.__elements
     
     def rays(self):
+        """
+        All retained rays, Ray() views are created for the rays of retained bundles
+        """
+        return self.__rays + [ray for bundle in self.__bundles for ray in bundle]
+    
+    def loose(self):
+        """
+        The retained Ray() objects which were propagated one by one
+        """
         return self.__rays
     
+    def bundles(self):
+        """
+        The retained RayBundle() objects
+        """
+        return self.__bundles
+    
+    def retain(self):
+        return self.__retain
+    
+    def sequential(self):
+        return self.__sequential
+    
+    def maxbounces(self):
+        return self.__maxbounces
+    
+    def hooks(self):
+        return self.__hooks
+    
+    def addhook(self, hook):
+        """
+        Add an instrumentation hook, an object with the methods start(sim, bundle), element(index, elem, seconds, status)
+        and finish(sim, bundle, seconds)
+        """
+        self.__hooks.append(hook)
+    
+    def depth(self):
+        """
+        Number of vertices to reserve for each ray before a trace: the number of elements in sequential mode, which is exact,
+        and one more in non-sequential mode, where RayBundle.append() grows the buffer for the rays bouncing further
+        """
+        return len(self.__elements) if self.__sequential else min(len(self.__elements) + 1, self.__maxbounces)
+    
+    def __modified(self, index):
+        """
+        Drop the plans and remember the first element changed since the last trace
+        """
+        self.__plans = {}
+        self.__changed = index if self.__changed is None else min(self.__changed, index)
+    
     def appendelements(self, *elements):
         """
         Append optical elements to the system
         """
+        self.__modified(len(self.__elements))
         for elem in elements:
             #if isinstance(elem, opticalelements.OpticalElements()):
             self.__elements.append(elem)
         #else:
             #raise TypeError   
     
+    def replaceelement(self, index, elem):
+        """
+        Replace the optical element at index, e.g. with a copy made by its replace() method
+        """
+        self.__elements[index] = elem
+        self.__modified(index % len(self.__elements))
+    
+    def insertelement(self, index, elem):
+        """
+        Insert an optical element before index
+        """
+        N = len(self.__elements)
+        self.__elements.insert(index, elem)
+        self.__modified(min(index, N) if index >= 0 else max(N + index, 0)) #where list.insert() put it
+    
+    def compile(self, dtype=float):
+        """
+        Freeze the elements into a Plan() holding their precomputed constants in the precision dtype.
+        The plan is kept until the elements change, so propagating new bundles through the same system reuses it.
+        """
+        dtype = rays.precision(dtype)
+        if dtype not in self.__plans:
+            self.__plans[dtype] = Plan(self.__elements, dtype)
+        return self.__plans[dtype]
+    
     def propagate(self, objectlist):
         """
         Append a bundle of Ray() objects to the system and then propagate
+        A RayBundle() is propagated through every element at once with the batch methods.
         """
+        if isinstance(objectlist, rays.RayBundle):
+            self.trace(objectlist)
+            self.__record(objectlist)
+            return
         
         for point in objectlist:
             #if isinstance(point, rays.Ray()):
-            self.__rays.append(point)
+            if self.__retain:
+                self.__rays.append(point)
+            if not self.__sequential:
+                if not point.terminated:
+                    self.__nonsequential(point.bundle(), np.array([point.index()]))
+                continue
             for elem in self.__elements:
+                if point.terminated:
+                    break
                 elem.propagate_ray(point)
         #else:
             #raise TypeError
                 
+    def propagate_iter(self, source, chunk_size=65536):
+        """
+        Propagate the rays of a source lazily, one RayBundle() of at most chunk_size rays at a time, and yield each traced chunk.
+        The source may be a RayBundle(), an object with a chunks(chunk_size) method or an iterable of RayBundle() or Ray() objects,
+        loose Ray() objects are copied into new bundles.
+        Only the chunk being traced is held in memory unless retain is True.
+        """
+        if isinstance(source, rays.RayBundle):
+            source.reserve(source.count().max(initial=1) + self.depth())
+        for chunk in _chunks(source, chunk_size):
+            self.trace(chunk)
+            self.__record(chunk)
+            yield chunk
+        
+    def __record(self, bundle):
+        """
+        Keep a propagated bundle when rays are retained
+        """
+        if self.__retain:
+            self.__bundles.append(bundle)
+    
+    def trace(self, bundle):
+        """
+        Propagate all rays of a RayBundle() through the elements in place, one batch call per element.
+        Terminated rays are dropped from the active set, so later elements only see the rays still alive.
+        The bundle is not appended to the system.
+        """
+        if len(bundle) == 0:
+            return
+        checkpoints = None
+        if self.__checkpoint:
+            self.__traced, self.__checkpoints, self.__changed = bundle, [], None
+            checkpoints = self.__checkpoints
+        self.__run(bundle, np.flatnonzero(bundle.alive()), 0, checkpoints)
+    
+    def retrace(self):
+        """
+        Bring the last bundle traced with checkpoints=True up to date with the elements, in place, and return it.
+        The rays are restored to their state before the first element replaced, inserted or appended since they were traced
+        and propagated from there, so moving the last elements only costs the work of those elements.
+        In non-sequential mode a ray may meet any element, so the rays are traced again from their initial state.
+        """
+        if self.__traced is None:
+            raise ValueError("No checkpointed trace to resume, trace a bundle with checkpoints=True first.")
+        bundle = self.__traced
+        if self.__changed is None:
+            return bundle
+        start = min(self.__changed, len(self.__checkpoints) - 1) if self.__sequential else 0
+        active, count, k = self.__checkpoints[start]
+        del self.__checkpoints[start:]
+        self.__changed = None
+        bundle.count()[active] = count #the later vertices are dropped
+        bundle.ksetter(k, active)
+        bundle.status()[active] = rays.ALIVE
+        self.__run(bundle, active, start, self.__checkpoints)
+        return bundle
+    
+    def __run(self, bundle, active, start, checkpoints):
+        """
+        Propagate the rays given by active from the element start on, telling the hooks
+        """
+        hooks = self.__hooks
+        if hooks:
+            for hook in hooks:
+                hook.start(self, bundle)
+            begin = time.perf_counter()
+        bundle.reserve(bundle.count().max() + self.depth())
+        if self.__sequential:
+            self.__inorder(bundle, active, start, checkpoints)
+        else:
+            if checkpoints is not None:
+                checkpoints.append((active, bundle.count()[active].copy(), bundle.k()[active].copy()))
+            self.__nonsequential(bundle, active)
+        if hooks:
+            seconds = time.perf_counter() - begin
+            for hook in hooks:
+                hook.finish(self, bundle, seconds)
+            
+    def __inorder(self, bundle, active, start=0, checkpoints=None):
+        """
+        Propagate the rays given by active in place through the elements in list order, from the element start on.
+        The rays still alive before each element, with their number of vertices and direction, are appended to checkpoints if given.
+        """
+        plan = self.compile(bundle.dtype())
+        hooks = self.__hooks
+        if plan.dispersive():
+            waves, group = np.unique(bundle.wavelength(), return_inverse=True)
+        for index in range(start, len(plan)):
+            if checkpoints is not None:
+                checkpoints.append((active, bundle.count()[active].copy(), bundle.k()[active].copy()))
+            if len(active) == 0:
+                break
+            kernel, constants, media = plan.stages()[index]
+            if media is not None: #index ratios of every ray looked up from one table per distinct wavelength
+                n1, n2 = media[0].table(waves), media[1].table(waves)
+                constants = constants._replace(ratio=(n1 / n2).astype(plan.dtype())[group[active]], critical=(n2 / n1).astype(plan.dtype())[group[active]])
+            if hooks:
+                begin = time.perf_counter()
+            newp, newk, status = kernel(constants, bundle.p(active), bundle.k()[active])
+            if hooks:
+                seconds = time.perf_counter() - begin
+                for hook in hooks:
+                    hook.element(index, plan.elements()[index], seconds, status)
+            landed = (status == rays.ALIVE) | (status == rays.TIR) #rays reaching the surface record a vertex
+            bundle.append(newp[landed], active[landed])
+            alive = status == rays.ALIVE
+            bundle.ksetter(newk[alive], active[alive])
+            bundle.status()[active[~alive]] = status[~alive]
+            active = active[alive]
+        else:
+            if checkpoints is not None:
+                checkpoints.append((active, bundle.count()[active].copy(), bundle.k()[active].copy()))
+            
+    def __nonsequential(self, bundle, active):
+        """
+        Propagate the rays given by active in place, every ray landing on the nearest element it hits whatever its place in the list.
+        A ray stops when it hits nothing more, lands on an OutputPlane() or is lost to total internal reflection,
+        rays refracting at the elements cross them in either direction and mirrors reflect them back. Rays still hitting elements after maxbounces are terminated.
+        Hooks are told the time taken by the interactions at each element, the search for the nearest element is not included.
+        """
+        plan = self.compile(bundle.dtype())
+        hooks = self.__hooks
+        elements, stages = plan.elements(), plan.stages()
+        if plan.dispersive():
+            waves, group = np.unique(bundle.wavelength(), return_inverse=True)
+        for bounce in range(self.__maxbounces + 1):
+            if len(active) == 0:
+                break
+            p, khat = bundle.p(active), ut.hats(bundle.k()[active])
+            ray, item, distance = plan.nearest(p, khat)
+            if bounce == self.__maxbounces:
+                bundle.status()[active[ray]] = rays.BOUNCES
+                break
+            hit = active[ray]
+            newp = p[ray] + distance[:, np.newaxis] * khat[ray]
+            bundle.append(newp, hit)
+            following = []
+            for i in np.unique(item):
+                elem = elements[i]
+                select = item == i
+                if hooks:
+                    begin = time.perf_counter()
+                if isinstance(elem, opticalelements.OutputPlane): #the rays are detected
+                    if hooks:
+                        for hook in hooks:
+                            hook.element(i, elem, time.perf_counter() - begin, np.full(np.count_nonzero(select), rays.ALIVE, dtype=np.int8))
+                    continue
+                kernel, constants, media = stages[i]
+                ratio, critical = constants.ratio, constants.critical
+                if media is not None:
+                    n1, n2 = media[0].table(waves)[group[hit[select]]], media[1].table(waves)[group[hit[select]]]
+                    ratio, critical = (n1 / n2).astype(plan.dtype()), (n2 / n1).astype(plan.dtype())
+                normal = elem.normal_compiled(constants, newp[select])
+                newk, tir = opticalelements.interact(khat[ray[select]], normal, ratio, critical, constants.mode, either=True)
+                bundle.ksetter(newk[~tir], hit[select][~tir])
+                bundle.status()[hit[select][tir]] = rays.TIR
+                following.append(hit[select][~tir])
+                if hooks:
+                    seconds = time.perf_counter() - begin
+                    for hook in hooks:
+                        hook.element(i, elem, seconds, np.where(tir, rays.TIR, rays.ALIVE).astype(np.int8))
+            active = np.concatenate(following) if following else np.zeros(0, dtype=int)
+            
+    def propagate_parallel(self, bundle, workers=None, shards=None):
+        """
+        Append a RayBundle() to the system and propagate it in a pool of worker processes.
+        The ray arrays are placed in shared memory and split into contiguous shards which the workers trace in place,
+        so the result and the order of the rays are the same as for propagate().
+        The elements are sent to each worker once, when the pool starts.
+        Hooks only see the whole run, the elements are met in the workers.
+        """
+        hooks = self.__hooks
+        for hook in hooks:
+            hook.start(self, bundle)
+        begin = time.perf_counter()
+        workers = workers or os.cpu_count() or 1
+        shards = shards or 4 * workers
+        N = len(bundle)
+        bundle.reserve(bundle.count().max() + self.depth())
+        arrays = {"vertices": bundle.vertices(), "count": bundle.count(), "k": bundle.k(), "freq": bundle.freq(), "wavelength": bundle.wavelength(), "status": bundle.status()}
+        blocks = {}
+        try:
+            for name, array in arrays.items():
+                blocks[name] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, array.dtype, buffer=blocks[name].buf)[:] = array
+            buffers = {name: (blocks[name].name, array.shape, array.dtype.str) for name, array in arrays.items()}
+            bounds = np.linspace(0, N, min(shards, max(N, 1)) + 1).astype(int)
+            with ProcessPoolExecutor(workers, initializer=_initworker, initargs=(self.__elements, buffers, self.__sequential, self.__maxbounces)) as pool:
+                overflows = [overflow for overflow in pool.map(_traceshard, bounds[:-1], bounds[1:]) if overflow is not None]
+            for name, array in arrays.items():
+                array[:] = np.ndarray(array.shape, array.dtype, buffer=blocks[name].buf)
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+        width = arrays["vertices"].shape[1]
+        for start, stop, extra in overflows: #vertices beyond the shared buffer, of rays bouncing more than it holds
+            bundle.reserve(width + extra.shape[1])
+            bundle.vertices()[start:stop, width:width + extra.shape[1]] = extra
+        for hook in hooks:
+            hook.finish(self, bundle, time.perf_counter() - begin)
+        self.__record(bundle)
+                
     def __repr__(self):
-        return "%s(elements=%s, rays=%s)" % ("Simulation", self.__elements, self.__rays)
+        return "%s(elements=%s, rays=%s)" % ("Simulation", self.__elements, self.rays())
+
+def _chunks(source, chunk_size):
+    """
+    Split a source of rays into RayBundle() chunks
+    """
+    if isinstance(source, rays.RayBundle):
+        yield from source.chunks(chunk_size)
+    elif hasattr(source, "chunks"):
+        yield from source.chunks(chunk_size)
+    else:
+        loose = []
+        for item in source:
+            if isinstance(item, rays.RayBundle):
+                yield from item.chunks(chunk_size)
+                continue
+            loose.append(item)
+            if len(loose) == chunk_size:
+                yield _bundle(loose)
+                loose = []
+        if loose:
+            yield _bundle(loose)
+            
+def _bundle(objectlist):
+    """
+    Copy the current state of Ray() objects into a new RayBundle()
+    """
+    return rays.RayBundle([ray.p() for ray in objectlist], [ray.k() for ray in objectlist], [ray.freq() for ray in objectlist],
+                          wavelength=[ray.wavelength() for ray in objectlist])
+
+class Plan:
+    """
+    An immutable compiled optical system.
+    Every stage holds the batch kernel of an element and the constants it precomputed: centre, curvature radius squared,
+    index ratio, normal and aperture bound squared.
+    Elements between dispersive media also keep their two media, the index ratios are then looked up per wavelength during the trace.
+    The constants are held in the precision of the rays traced with the plan, float64 or float32.
+    The bounding-volume hierarchy of the elements used by non-sequential tracing is built on first use.
+    """
+    
+    __slots__ = ("__elements", "__stages", "__dtype", "__bvh")
+    
+    def __init__(self, elements, dtype=float):
+        self.__elements = tuple(elements)
+        self.__dtype = rays.precision(dtype)
+        self.__stages = tuple((elem.propagate_compiled, self.__cast(elem.compile()), (elem.medium1(), elem.medium2()) if elem.dispersive() else None)
+                              for elem in self.__elements)
+        self.__bvh = None
+    
+    def __cast(self, constants):
+        return constants if self.__dtype == np.float64 else opticalelements.cast(constants, self.__dtype)
         
+    def elements(self):
+        return self.__elements
+    
+    def stages(self):
+        return self.__stages
+    
+    def dtype(self):
+        return self.__dtype
+    
+    def __len__(self):
+        return len(self.__stages)
+    
+    def dispersive(self):
+        return any(media is not None for kernel, constants, media in self.__stages)
+    
+    def bvh(self):
+        if self.__bvh is None:
+            lower, upper = zip(*(elem.bounds() for elem in self.__elements)) if self.__elements else ((), ())
+            self.__bvh = bvh.BVH(lower, upper)
+        return self.__bvh
+    
+    def nearest(self, p, khat):
+        """
+        Nearest hit of the (N, 3) rays among the elements, found with the bounding-volume hierarchy.
+        Return the indices of the rays hitting an element, the index of that element and the distance to it.
+        """
+        def distance(ray, item):
+            result = np.full(len(ray), np.nan)
+            for i in np.unique(item):
+                select = item == i
+                result[select] = self.__elements[i].distance_compiled(self.__stages[i][1], p[ray[select]], khat[ray[select]])
+            return result
+        best, item = self.bvh().nearest(p, khat, distance)
+        ray = np.flatnonzero(item >= 0)
+        return ray, item[ray], best[ray]
+    
+    def __repr__(self):
+        return "%s(elements=%s, dtype=%s)" % ("Plan", list(self.__elements), self.__dtype)
 
-       
-  
\ No newline at end of file
+_worker = {}
+
+def _initworker(elements, buffers, sequential=True, maxbounces=64):
+    """
+    Attach a pool worker to the shared ray arrays and keep its own copy of the elements.
+    """
+    sim = Simulation(sequential=sequential, maxbounces=maxbounces)
+    sim.appendelements(*elements)
+    sim.compile()
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, (block, shape, dtype) in buffers.items()}
+    arrays = {name: np.ndarray(shape, dtype, buffer=blocks[name].buf) for name, (block, shape, dtype) in buffers.items()}
+    _worker.update(sim=sim, blocks=blocks, arrays=arrays)
+    
+def _traceshard(start, stop):
+    """
+    Trace the rays start:stop of the shared arrays in place.
+    When the rays need more vertices than the shared buffer holds the shard grows a private buffer,
+    the vertices beyond the shared ones are then returned as (start, stop, vertices), otherwise None.
+    """
+    arrays = _worker["arrays"]
+    shard = rays.RayBundle.frombuffers(*(arrays[name][start:stop] for name in ("vertices", "count", "k", "freq", "wavelength", "status")))
+    _worker["sim"].trace(shard)
+    width = arrays["vertices"].shape[1]
+    if shard.vertices().shape[1] > width:
+        arrays["vertices"][start:stop] = shard.vertices()[:, :width]
+        return start, stop, shard.vertices()[:, width:]
+    return None
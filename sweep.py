@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sweep element parameters over grids of values and tabulate figures of merit of every point.
+The elements before the first varied one are the same for every point, so the rays are traced through them once
+and only the rest of the system is traced again per point.
+"""
+
+import csv
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rays
+import simulation
+import analysis
+import optimisation
+
+METRICS = ("alive", "rms", "maxradius", "bestfocus", "bestrms")
+
+def merit(bundle):
+    """
+    Figures of merit of traced rays: the fraction still alive, the RMS and geometric spot radii about the centroid
+    on the final element, and the best focus with its RMS radius from the final directions, see analysis.find_best_focus().
+    """
+    alive = bundle.alive()
+    p, k = bundle.p()[alive], bundle.k()[alive]
+    if len(p) == 0:
+        return {"alive": float(0), "rms": np.nan, "maxradius": np.nan, "bestfocus": np.nan, "bestrms": np.nan}
+    r = analysis.radii(p)
+    bestfocus, bestrms = analysis.best_focus(analysis.focus_moments(p, k))
+    return {"alive": alive.mean(), "rms": float(np.sqrt(np.mean(r * r))), "maxradius": float(r.max()),
+            "bestfocus": float(bestfocus), "bestrms": float(bestrms)}
+
+class Table:
+    """
+    A tidy table, one row per sweep point and one column per parameter or figure of merit.
+    The parameter columns are named name[index], e.g. z[2] for the position of element 2.
+    """
+
+    def __init__(self, columns, shared=0):
+        self.__columns = {name: np.asarray(column) for name, column in columns.items()}
+        self.__shared = int(shared)
+
+    def columns(self):
+        return self.__columns
+
+    def shared(self):
+        """
+        Number of leading elements traced once for all points
+        """
+        return self.__shared
+
+    def __len__(self):
+        return len(next(iter(self.__columns.values()))) if self.__columns else 0
+
+    def __getitem__(self, name):
+        return self.__columns[name]
+
+    def rows(self):
+        """
+        The rows as dictionaries
+        """
+        names = list(self.__columns)
+        return [dict(zip(names, (self.__columns[name][i].item() for name in names))) for i in range(len(self))]
+
+    def best(self, metric="rms"):
+        """
+        The row with the smallest value of a figure of merit
+        """
+        return self.rows()[int(np.nanargmin(self.__columns[metric]))]
+
+    def write_csv(self, filename):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.__columns))
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+    def dataframe(self):
+        """
+        The table as a pandas DataFrame, pandas is only needed here
+        """
+        import pandas
+        return pandas.DataFrame(self.__columns)
+
+    def __repr__(self):
+        return "%s(rows=%d, columns=%s)" % ("Table", len(self), list(self.__columns))
+
+_worker = {}
+
+def _initworker(base, first, keys, state, sequential, maxbounces):
+    _worker.update(base=base, first=first, keys=keys, state=state, sequential=sequential, maxbounces=maxbounces)
+
+def _point(values):
+    """
+    Trace the shared state through the rest of the system of one sweep point and return its figures of merit.
+    """
+    elements = list(_worker["base"])
+    for (index, name), value in zip(_worker["keys"], values):
+        elements[index - _worker["first"]] = optimisation.modified(elements[index - _worker["first"]], name, value)
+    sim = simulation.Simulation(sequential=_worker["sequential"], maxbounces=_worker["maxbounces"])
+    sim.appendelements(*elements)
+    p, k, freq, wavelength, status = _worker["state"]
+    bundle = rays.RayBundle.frombuffers(p.copy()[:, np.newaxis], np.ones(len(p), dtype=int), k.copy(), freq, wavelength, status.copy())
+    sim.trace(bundle)
+    return merit(bundle)
+
+def sweep(sim, source, grid, workers=None, chunk_size=65536):
+    """
+    Trace a source through the system of a Simulation() for every combination of the parameter grids.
+    grid maps (element index, name) to the values to try, name being z or any parameter of the element, e.g. curv or n2.
+    The elements before the first varied one are traced once, in non-sequential mode the whole system is traced per point.
+    The points are traced in a pool of worker processes when workers is more than 1.
+    Return a Table() of the parameters and figures of merit, see merit().
+    """
+    elements = list(sim.elements())
+    keys = list(grid)
+    points = list(itertools.product(*(np.ravel(grid[key]).tolist() for key in keys)))
+    first = min(index for index, name in keys) if keys and sim.sequential() else 0
+    prefix = simulation.Simulation(sequential=sim.sequential(), maxbounces=sim.maxbounces())
+    prefix.appendelements(*elements[:first])
+    bundle = rays.collect(source, chunk_size)
+    prefix.trace(bundle)
+    state = (bundle.p(), bundle.k(), bundle.freq(), bundle.wavelength(), bundle.status())
+    settings = (elements[first:], first, keys, state, sim.sequential(), sim.maxbounces())
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_initworker, initargs=settings) as pool:
+            merits = list(pool.map(_point, points, chunksize=max(len(points) // (4 * workers), 1)))
+    else:
+        _initworker(*settings)
+        merits = [_point(values) for values in points]
+        _worker.clear()
+    columns = {"%s[%d]" % (name, index): np.array([values[j] for values in points]) for j, (index, name) in enumerate(keys)}
+    columns.update({metric: np.array([result[metric] for result in merits]) for metric in METRICS})
+    return Table(columns, first)
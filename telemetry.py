@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Collect run telemetry from a Simulation() through its instrumentation hooks.
+The counters are exported as a dictionary or in the Prometheus text format, e.g. for the textfile collector of node exporter.
+"""
+
+import os
+import sys
+import tracemalloc
+import numpy as np
+import rays
+
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
+
+def peakrss():
+    """
+    Peak resident memory of the process in bytes, None where it cannot be read
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 #kilobytes on Linux
+
+class Telemetry:
+    """
+    An instrumentation hook counting, for every element, the wall time of its batch kernel, the rays in and out
+    and the rays it terminated for each reason, together with the rays and the wall time of every trace.
+    The peak memory is that of the process, or with tracememory=True the peak allocated during the traces as seen by tracemalloc,
+    which slows the traces down.
+    """
+
+    def __init__(self, tracememory=False):
+        self.__tracememory = bool(tracememory)
+        self.__started = False
+        self.reset()
+
+    def reset(self):
+        self.__traces = 0
+        self.__rays = 0
+        self.__seconds = float(0)
+        self.__peak = 0
+        self.__elements = {}
+
+    def start(self, sim, bundle):
+        if self.__tracememory:
+            self.__started = not tracemalloc.is_tracing()
+            if self.__started:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    def element(self, index, elem, seconds, status):
+        counters = self.__elements.setdefault(int(index), {"type": type(elem).__name__, "seconds": float(0), "rays_in": 0, "rays_out": 0,
+                                                      **{reason: 0 for code, reason in rays.REASONS.items() if code != rays.ALIVE}})
+        counts = np.bincount(status, minlength=len(rays.REASONS))
+        counters["seconds"] += seconds
+        counters["rays_in"] += len(status)
+        counters["rays_out"] += int(counts[rays.ALIVE])
+        for code, reason in rays.REASONS.items():
+            if code != rays.ALIVE:
+                counters[reason] += int(counts[code])
+
+    def finish(self, sim, bundle, seconds):
+        self.__traces += 1
+        self.__rays += len(bundle)
+        self.__seconds += seconds
+        if self.__tracememory:
+            self.__peak = max(self.__peak, tracemalloc.get_traced_memory()[1])
+            if self.__started:
+                tracemalloc.stop()
+        else:
+            self.__peak = peakrss() or 0
+
+    def rays_per_second(self):
+        return self.__rays / self.__seconds if self.__seconds > 0 else float(0)
+
+    def asdict(self):
+        """
+        The counters as a dictionary, the elements listed by their index in the system.
+        """
+        return {"traces": self.__traces, "rays": self.__rays, "seconds": self.__seconds, "rays_per_second": self.rays_per_second(),
+                "peak_memory": self.__peak, "elements": [dict(index=index, **counters) for index, counters in sorted(self.__elements.items())]}
+
+    def prometheus(self, prefix="raytracer"):
+        """
+        The counters in the Prometheus text exposition format.
+        """
+        lines = []
+        def metric(name, kind, description, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, description))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for labels, value in samples:
+                lines.append("%s_%s%s %s" % (prefix, name, labels, value if isinstance(value, int) else repr(float(value))))
+
+        metric("traces_total", "counter", "Bundles traced.", [("", self.__traces)])
+        metric("rays_total", "counter", "Rays traced.", [("", self.__rays)])
+        metric("trace_seconds_total", "counter", "Wall time spent tracing.", [("", self.__seconds)])
+        metric("rays_per_second", "gauge", "Rays traced per second of wall time.", [("", self.rays_per_second())])
+        metric("peak_memory_bytes", "gauge", "Peak memory.", [("", self.__peak)])
+        elements = sorted(self.__elements.items())
+        labels = ['{element="%d",type="%s"}' % (index, counters["type"]) for index, counters in elements]
+        metric("element_seconds_total", "counter", "Wall time spent in the batch kernel of the element.",
+               [(label, counters["seconds"]) for label, (index, counters) in zip(labels, elements)])
+        metric("element_rays_in_total", "counter", "Rays reaching the element.",
+               [(label, counters["rays_in"]) for label, (index, counters) in zip(labels, elements)])
+        metric("element_rays_out_total", "counter", "Rays leaving the element.",
+               [(label, counters["rays_out"]) for label, (index, counters) in zip(labels, elements)])
+        for code, reason in rays.REASONS.items():
+            if code != rays.ALIVE:
+                metric("element_%s_total" % reason, "counter", "Rays terminated at the element, reason %s." % reason,
+                       [(label, counters[reason]) for label, (index, counters) in zip(labels, elements)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename, prefix="raytracer"):
+        """
+        Write the counters in the Prometheus text format, replacing the file at once so a scrape never sees half of it.
+        """
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.prometheus(prefix))
+        os.replace(temporary, filename)
+
+    def __repr__(self):
+        return "%s(traces=%d, rays=%d, rays_per_second=%g)" % ("Telemetry", self.__traces, self.__rays, self.rays_per_second())
@@ -12,6 +12,8 @@ import rays
 import opticalelements
 import simulation
 import graphics
+import materials
+import cache
 import numpy as np
 
 #%% create objects
@@ -168,7 +170,7 @@ r_tir_task5
 
 #%% create objects
 
-s_task7 = opticalelements.SphericalRefraction(0.2,0.15,[0,0,1])
+s_task7 = opticalelements.SphericalRefraction(0.2,5,[0,0,1]) #aperture covers the whole hemisphere
 
 r_task7 = rays.Ray([0,1,0])
 
@@ -185,7 +187,7 @@ Propagate rays
 s_task7.propagate_ray(r_task7)
 
 r_task7
-#Ray(p=[0.         1.         1.10102051], k=[ 0.         -0.06607142  0.99034918], vertices=[array([0., 1., 0.]), array([0.        , 1.        , 1.10102051])], freq=1)
+#Ray(p=[0.         1.         1.10102051], k=[ 0.         -0.0675748   0.99771421], vertices=[array([0., 1., 0.]), array([0.        , 1.        , 1.10102051])], freq=1)
 #Successfully propagated
 
 """
@@ -229,7 +231,7 @@ r_task8
 
 #%% create objects
 
-sim_task9 = simulation.Simulation()
+sim_task9 = simulation.Simulation(retain=True)
 
 r_y1_task9 = rays.Ray([0,1,0])
 
@@ -262,7 +264,7 @@ graphics.render3d(sim_task9, "Task 9", -3, 3, -3, 3)
 
 #%% create objects
 
-sim_task10 = simulation.Simulation()
+sim_task10 = simulation.Simulation(retain=True)
 
 r1_task10 = rays.Ray([0,0.1,0])
 
@@ -290,15 +292,15 @@ graphics.render3d(sim_task10, "Task 10", -20,20,-20,20)
 theta = abs(r1_task10.k()[1] / r1_task10.k()[2])
 
 print(theta)
-#0.001000000166666071
+#0.0010000035000191265
 
 paraxialfocus = (r1_task10.vertices()[1][2] + r1_task10.vertices()[0][1] / theta)
 print(paraxialfocus)
-#200.00013333373323
+#199.9997999996499
 
 #%% create objects
 
-sim_task11 = simulation.Simulation()
+sim_task11 = simulation.Simulation(retain=True)
 
 r_task11 = rays.Ray()
 
@@ -347,13 +349,13 @@ sim_task11
 
 #%% create objects
 
-sim_task12 = simulation.Simulation()
+sim_task12 = simulation.Simulation(retain=True)
 
 b_task12 = rays.UniformCollimatedBeam() 
 
 s_task12 = opticalelements.SphericalRefraction(0.03, 1/0.03, [0,0,100])
 
-o_task12 = opticalelements.OutputPlane([0,0,200.00013333373323]) 
+o_task12 = opticalelements.OutputPlane([0,0,199.9997999996499]) 
 
 #%% task 12
 """
@@ -379,22 +381,22 @@ graphics.render2d(sim_task12, "Task 13", -0.002, 0.002, -0.002, 0.002)
 RMS spot radius
 """
 b_task12.rms(sim_task12)
-#0.0009884228132171987 mm
+#0.0023761423129835943 mm
 
 distance = 250 - 100
 
 alpha = np.arctan(b_task12.rms(sim_task12)/ distance)
 
 print(2*alpha)
-#1.3178970842705234e-05 rad
+#3.168189750379788e-05 rad
 #%% task 14
 """
 Diffraction limit = 1.22 * lambda * focal length / aberture diameter
 """
-dlim = 1.22 * (1/3e8) * 200.00013333373323 / 5 #wavelength so small number doesnt matter
+dlim = 1.22 * (1/3e8) * 199.9997999996499 / 5 #wavelength so small number doesnt matter
 
 print(dlim)
-#1.6266677511143636e-07 factor of 2 out
+#1.6266650399971525e-07 factor of 2 out
 
 #%% create objects
 
@@ -404,15 +406,15 @@ r_task15 = rays.Ray([0,0.1,0])
 
 s_task15 = opticalelements.SphericalRefraction(0.02, 1/0.02, [0,0,100], 1, 1.5168)
 
-p_task15 = opticalelements.Plane([0,0,105], 1.5168)
+p_task15 = opticalelements.Plane([0,0,105], 1.5168, width=np.array([5,0,0]), height=np.array([0,5,0])) #large enough for the whole beam
 
 o_task15 =  opticalelements.OutputPlane([0,0,250])
 
 b_task15 = rays.UniformCollimatedBeam(np.zeros(3), np.array([0,0,1]), 5, 1.25)
 
-sim_part1_task15 = simulation.Simulation()
+sim_part1_task15 = simulation.Simulation(retain=True)
 
-o_part1_task15 = opticalelements.OutputPlane([0,0,245.12392329876656])
+o_part1_task15 = opticalelements.OutputPlane([0,0,245.1237132005839])
 
 #%% task 15 part 1
 """
@@ -426,11 +428,11 @@ sim_task15.propagate([r_task15])
 theta = abs(r_task15.k()[1] / r_task15.k()[2])
 
 print(theta) 
-#0.0006890667412627269
+#0.0006890677388376005
 
 paraxialfocus = (r_task15.vertices()[1][2] + r_task15.vertices()[0][1] / theta)
 print(paraxialfocus)
-#245.12392329876656 
+#245.1237132005839 
 
 b_task15.generate()
 
@@ -446,7 +448,7 @@ graphics.render2d(sim_part1_task15, "Task 15.2", -0.01, 0.01, -0.01, 0.01)
 RMS spot radius
 """
 b_task15.rms(sim_part1_task15)
-#0.005501345612560001
+#0.006792720725938307
 
 #%% create objects
 
@@ -456,15 +458,15 @@ rr_task15 = rays.Ray([0,0.1,0])
 
 ss_task15 = opticalelements.SphericalRefraction(0.02, 1/0.02, [0,0,105], 1, 1.5168)
 
-pp_task15 = opticalelements.Plane([0,0,100], 1.5168)
+pp_task15 = opticalelements.Plane([0,0,100], 1.5168, width=np.array([5,0,0]), height=np.array([0,5,0]))
 
 oo_task15 =  opticalelements.OutputPlane([0,0,250])
 
 bb_task15 = rays.UniformCollimatedBeam(np.zeros(3), np.array([0,0,1]), 5, 1.25)
 
-simm_part2_task15 = simulation.Simulation()
+simm_part2_task15 = simulation.Simulation(retain=True)
 
-oo_part2_task15 = opticalelements.OutputPlane([0,0,250.12392329876644])
+oo_part2_task15 = opticalelements.OutputPlane([0,0,250.12371320058375])
 
 #%% task 15 part 2
 
@@ -475,11 +477,11 @@ simm_task15.propagate([rr_task15])
 thetaa = abs(rr_task15.k()[1] / rr_task15.k()[2])
 
 print(thetaa) 
-#0.0006890667412627279
+#0.0006890677388376014
 
 paraxialfocuss = (rr_task15.vertices()[1][2] + rr_task15.vertices()[0][1] / thetaa)
 print(paraxialfocuss)
-#250.12392329876644 
+#250.12371320058375 
 
 bb_task15.generate()
 
@@ -495,4 +497,112 @@ graphics.render2d(simm_part2_task15, "Task 15.4", -0.01, 0.01, -0.01, 0.01)
 RMS spot radius
 """
 bb_task15.rms(simm_part2_task15)
-#0.005610358498606609
+#0.008892606887263411
+
+#%% create objects
+
+sim_a_cache = simulation.Simulation()
+
+sim_b_cache = simulation.Simulation()
+
+b_cache = rays.UniformCollimatedBeam(np.zeros(3), np.array([0,0,1]), 5, 1.25)
+
+#%% cache keys
+"""
+Systems differing only in the 7th significant digit of a Cauchy coefficient are different systems
+"""
+sim_a_cache.appendelements(opticalelements.SphericalRefraction(0.02, 1/0.02, [0,0,100], 1, materials.Cauchy(1.5168001)), opticalelements.OutputPlane([0,0,250]))
+sim_b_cache.appendelements(opticalelements.SphericalRefraction(0.02, 1/0.02, [0,0,100], 1, materials.Cauchy(1.5168002)), opticalelements.OutputPlane([0,0,250]))
+
+cache.key(sim_a_cache, b_cache) != cache.key(sim_b_cache, b_cache)
+#True
+
+#%% create objects
+
+seq_bvh = simulation.Simulation()
+
+nonseq_bvh = simulation.Simulation(sequential=False)
+
+b_bvh = rays.UniformCollimatedBeam(np.zeros(3), np.array([0,0,1]), 5, 1.25)
+
+#%% non-sequential tracing
+"""
+With sequential=False each ray meets the nearest element on its path, found with the bounding-volume hierarchy,
+so the order of the element list does not matter
+"""
+seq_bvh.appendelements(s_task15, p_task15, o_task15)
+nonseq_bvh.appendelements(o_task15, p_task15, s_task15)
+
+bundle_seq_bvh = rays.RayBundle(b_bvh.positions(), np.array([0,0,1]))
+bundle_nonseq_bvh = rays.RayBundle(b_bvh.positions(), np.array([0,0,1]))
+
+seq_bvh.trace(bundle_seq_bvh)
+nonseq_bvh.trace(bundle_nonseq_bvh)
+
+np.array_equal(bundle_seq_bvh.p(), bundle_nonseq_bvh.p()), np.array_equal(bundle_seq_bvh.k(), bundle_nonseq_bvh.k())
+#(True, True)
+
+np.array_equal(bundle_seq_bvh.count(), bundle_nonseq_bvh.count()), np.array_equal(bundle_seq_bvh.status(), bundle_nonseq_bvh.status())
+#(True, True)
+
+len(bundle_nonseq_bvh), bundle_nonseq_bvh.alive().sum()
+#(91, 91)
+
+#%% create objects
+
+sim_checkpoint = simulation.Simulation(checkpoints=True)
+
+fresh_checkpoint = simulation.Simulation()
+
+o_checkpoint = opticalelements.OutputPlane([0,0,245.1237132005839])
+
+#%% checkpoints
+"""
+After replacing the OutputPlane() retrace() resumes the rays from the checkpoint before it,
+the result must be the same as tracing the edited system from scratch
+"""
+sim_checkpoint.appendelements(s_task15, p_task15, o_task15)
+fresh_checkpoint.appendelements(s_task15, p_task15, o_checkpoint)
+
+bundle_checkpoint = rays.RayBundle(b_bvh.positions(), np.array([0,0,1]))
+bundle_fresh_checkpoint = rays.RayBundle(b_bvh.positions(), np.array([0,0,1]))
+
+sim_checkpoint.trace(bundle_checkpoint)
+bundle_checkpoint.p()[0]
+#array([  0.,   0., 250.])
+
+sim_checkpoint.replaceelement(2, o_checkpoint)
+sim_checkpoint.retrace() is bundle_checkpoint
+#True
+
+fresh_checkpoint.trace(bundle_fresh_checkpoint)
+bundle_checkpoint.p()[0]
+#array([  0.       ,   0.       , 245.1237132])
+
+np.array_equal(bundle_checkpoint.p(), bundle_fresh_checkpoint.p()), np.array_equal(bundle_checkpoint.k(), bundle_fresh_checkpoint.k())
+#(True, True)
+
+np.array_equal(bundle_checkpoint.count(), bundle_fresh_checkpoint.count()), np.array_equal(bundle_checkpoint.status(), bundle_fresh_checkpoint.status())
+#(True, True)
+
+#%% create objects
+
+sim_float32 = simulation.Simulation()
+
+#%% float32 precision
+"""
+A float32 plan keeps the rays in float32 through every kernel, nothing is promoted to float64 on the way
+"""
+sim_float32.appendelements(s_task15, p_task15, o_task15)
+
+bundle_float32 = rays.RayBundle(b_bvh.positions(), np.array([0,0,1]), dtype=np.float32)
+
+p_float32, k_float32 = bundle_float32.p(), bundle_float32.k()
+
+dtypes_float32 = []
+for kernel, constants, media in sim_float32.compile(np.float32).stages():
+    p_float32, k_float32, status_float32 = kernel(constants, p_float32, k_float32)
+    dtypes_float32.append((p_float32.dtype.name, k_float32.dtype.name))
+
+dtypes_float32
+#[('float32', 'float32'), ('float32', 'float32'), ('float32', 'float32')]
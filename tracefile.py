@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Save traced rays to disk and open them again without retracing.
+A trace is a directory holding a JSON header, with the description of the system, and one raw binary file per array:
+final positions, directions, frequencies, wavelengths, status codes and the vertex histories of all rays back to back
+with the offset of the first vertex of every ray.
+The arrays are written chunk by chunk and read back with numpy.memmap, so only the pages used are ever read.
+"""
+
+import json
+import os
+import numpy as np
+import rays
+import materials
+
+VERSION = 1
+COMPRESSIONS = (None, "float32", "delta")
+
+def jsonable(value):
+    """
+    A parameter of an element as a JSON value, media are given by their full-precision params() and other objects by their repr
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.floating, np.integer)):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, materials.Medium):
+        return value.params()
+    return repr(value)
+
+def describe(elements):
+    """
+    JSON description of a list of optical elements, their type and the parameters which rebuild them
+    """
+    return [{"type": type(elem).__name__, "params": {name: jsonable(value) for name, value in elem.params().items()}} for elem in elements]
+
+def layout(compression):
+    """
+    Data types of the stored arrays for a compression mode.
+    With 'float32' all coordinates are stored in single precision. With 'delta' the final positions and directions are kept
+    in double precision, so spot analysis is exact, and every vertex is stored in single precision as its offset from
+    the final position of its ray, which is exact for the last vertex.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError("compression must be one of %s." % (COMPRESSIONS,))
+    real = "<f4" if compression == "float32" else "<f8"
+    return {"p": (real, (3,)), "k": (real, (3,)), "freq": ("<f8", ()), "wavelength": ("<f8", ()), "status": ("|i1", ()),
+            "offsets": ("<i8", ()), "vertices": ("<f4" if compression else "<f8", (3,))}
+
+class TraceWriter:
+    """
+    Write traced RayBundle() chunks to a trace directory as they are produced.
+    The header is written by close(), a trace which was never closed cannot be opened.
+    """
+
+    def __init__(self, path, elements=(), compression=None):
+        self.__path = path
+        self.__compression = compression
+        self.__layout = layout(compression)
+        self.__elements = describe(elements)
+        self.__rays = 0
+        self.__vertices = 0
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, "header.json")):
+            os.remove(os.path.join(path, "header.json"))
+        self.__files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in self.__layout}
+        self.__files["offsets"].write(np.zeros(1, dtype="<i8").tobytes())
+
+    def path(self):
+        return self.__path
+
+    def __len__(self):
+        return self.__rays
+
+    def write(self, bundle):
+        """
+        Append the rays of a traced bundle.
+        """
+        N = len(bundle)
+        if N == 0:
+            return
+        count = bundle.count()
+        p = bundle.p()
+        vertices = bundle.vertices()[np.arange(bundle.vertices().shape[1]) < count[:, np.newaxis]] #ray by ray, in order
+        if self.__compression == "delta":
+            vertices = np.repeat(p, count, axis=0) - vertices
+        arrays = {"p": p, "k": bundle.k(), "freq": bundle.freq(), "wavelength": bundle.wavelength(), "status": bundle.status(),
+                  "offsets": self.__vertices + np.cumsum(count), "vertices": vertices}
+        for name, array in arrays.items():
+            self.__files[name].write(np.ascontiguousarray(array, dtype=self.__layout[name][0]).tobytes())
+        self.__rays += N
+        self.__vertices += int(count.sum())
+
+    def close(self):
+        """
+        Flush the arrays and write the header.
+        """
+        if self.__files is None:
+            return
+        for f in self.__files.values():
+            f.close()
+        self.__files = None
+        header = {"version": VERSION, "rays": self.__rays, "vertices": self.__vertices, "compression": self.__compression,
+                  "arrays": {name: {"dtype": dtype, "shape": list(shape)} for name, (dtype, shape) in self.__layout.items()},
+                  "elements": self.__elements}
+        with open(os.path.join(self.__path, "header.json"), "w") as f:
+            json.dump(header, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "%s(path=%r, rays=%d, compression=%s)" % ("TraceWriter", self.__path, self.__rays, self.__compression)
+
+class TraceFile:
+    """
+    A trace directory opened with numpy.memmap, read-only.
+    It provides the accessors of a RayBundle() used by analysis and graphics, so analysis.spot() and graphics.render2d()
+    take it directly. The positions and directions are returned in double precision.
+    """
+
+    def __init__(self, path):
+        self.__path = path
+        with open(os.path.join(path, "header.json")) as f:
+            self.__header = json.load(f)
+        if self.__header["version"] > VERSION:
+            raise ValueError("Trace version %d is newer than this reader." % self.__header["version"])
+        self.__arrays = {}
+
+    def __array(self, name):
+        if name not in self.__arrays:
+            spec = self.__header["arrays"][name]
+            length = self.__header["vertices"] if name == "vertices" else self.__header["rays"] + (name == "offsets")
+            shape = (length, *spec["shape"])
+            if length == 0:
+                self.__arrays[name] = np.zeros(shape, dtype=spec["dtype"])
+            else:
+                self.__arrays[name] = np.memmap(os.path.join(self.__path, name + ".bin"), dtype=spec["dtype"], mode="r", shape=shape)
+        return self.__arrays[name]
+
+    def header(self):
+        return self.__header
+
+    def elements(self):
+        """
+        Description of the system which produced the trace
+        """
+        return self.__header["elements"]
+
+    def compression(self):
+        return self.__header["compression"]
+
+    def __len__(self):
+        return self.__header["rays"]
+
+    def p(self, index=None):
+        p = self.__array("p")
+        return np.asarray(p if index is None else p[index], dtype=float)
+
+    def k(self):
+        return np.asarray(self.__array("k"), dtype=float)
+
+    def freq(self):
+        return self.__array("freq")
+
+    def wavelength(self):
+        return self.__array("wavelength")
+
+    def status(self):
+        return self.__array("status")
+
+    def alive(self):
+        return self.status() == rays.ALIVE
+
+    def terminated(self):
+        return self.status() != rays.ALIVE
+
+    def count(self):
+        return np.diff(self.__array("offsets"))
+
+    def history(self, index):
+        """
+        The (M, 3) vertices of one ray.
+        """
+        offsets = self.__array("offsets")
+        vertices = np.asarray(self.__array("vertices")[offsets[index]:offsets[index + 1]], dtype=float)
+        if self.compression() == "delta":
+            vertices = self.p(index) - vertices
+        return vertices
+
+    def chunks(self, chunk_size):
+        """
+        Yield the final state of consecutive rays as RayBundle() objects of at most chunk_size rays,
+        e.g. for analysis.SpotStatistics(). Only the pages of one chunk are read at a time.
+        """
+        for start in range(0, len(self), int(chunk_size)):
+            stop = min(start + int(chunk_size), len(self))
+            p = self.p(slice(start, stop))
+            yield rays.RayBundle.frombuffers(p[:, np.newaxis], np.ones(stop - start, dtype=int), np.asarray(self.__array("k")[start:stop], dtype=float),
+                                             np.array(self.freq()[start:stop]), np.array(self.wavelength()[start:stop]), np.array(self.status()[start:stop]))
+
+    def __repr__(self):
+        return "%s(path=%r, rays=%d, compression=%s)" % ("TraceFile", self.__path, len(self), self.compression())
+
+def save(path, source, elements=(), compression=None):
+    """
+    Write a traced RayBundle(), or every bundle retained by a Simulation() together with its elements, to a trace directory.
+    """
+    if hasattr(source, "bundles"): #Simulation()
+        elements, bundles = source.elements(), source.bundles()
+    else:
+        bundles = [source]
+    with TraceWriter(path, elements, compression) as writer:
+        for bundle in bundles:
+            writer.write(bundle)
+    return TraceFile(path)
+
+def stream(sim, source, path, chunk_size=65536, compression=None):
+    """
+    Propagate a source of rays through a Simulation() chunk by chunk, see Simulation.propagate_iter(),
+    writing every chunk to the trace directory as soon as it is traced. Return the opened trace.
+    """
+    with TraceWriter(path, sim.elements(), compression) as writer:
+        for chunk in sim.propagate_iter(source, chunk_size):
+            writer.write(chunk)
+    return TraceFile(path)
+
+def load(path):
+    return TraceFile(path)
@@ -28,3 +28,20 @@ def hat(vec):
     """
     return vec / norm(vec)
 
+def dots(a, b):
+    """
+    Row-wise dot product of two (N, 3) arrays
+    """
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+def norms(vecs):
+    """
+    Normalisation of every row of an (N, 3) array
+    """
+    return np.sqrt(dots(vecs, vecs))
+
+def hats(vecs):
+    """
+    Return unit vectors in the direction of every row of an (N, 3) array
+    """
+    return vecs / norms(vecs)[:, np.newaxis]